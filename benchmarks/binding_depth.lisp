@@ -0,0 +1,15 @@
+(def bound-a 0)
+(def bound-b 0)
+(set-dynamic! (resolve 'user/bound-a))
+(set-dynamic! (resolve 'user/bound-b))
+
+(defn nest [n]
+  (if (eq n 0)
+    (+ bound-a bound-b)
+    (with-bindings ['user/bound-a n] (nest (- n 1)))))
+
+
+(loop [x 0] (if (eq x 200)
+                x (do (nest 100)
+                      (recur (+ x 1)))))
+:exit-repl
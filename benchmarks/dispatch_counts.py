@@ -0,0 +1,103 @@
+"""Counts interpreter calls and opcode dispatches for the benchmarks/*.lisp programs,
+with and without superinstructions. Runs untranslated, from the repository root:
+
+    python benchmarks/dispatch_counts.py [file.lisp ...]
+
+Long running benchmarks such as fn_recur.lisp are meant for a translated pixie-vm,
+pass the files to count explicitly to skip them.
+"""
+import glob
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+
+def run_benchmark(filename):
+    import pixie.vm.compiler as compiler
+    import pixie.vm.interpreter as interpreter
+    import pixie.vm.stacklet as stacklet
+    from pixie.vm.reader import StringReader, read, eof
+    from pixie.vm.keyword import keyword
+    from pixie.vm.code import wrap_fn
+    from pixie.vm.object import WrappedException
+
+    f = open(filename)
+    data = f.read()
+    f.close()
+
+    rdr = StringReader(unicode(data))
+    status = ["ok"]
+
+    @wrap_fn
+    def run():
+        with compiler.with_ns(u"user"):
+            compiler.NS_VAR.deref().include_stdlib()
+            while True:
+                form = read(rdr, False)
+                if form is eof or form is keyword(u"exit-repl"):
+                    return
+                try:
+                    compiler.compile(form).invoke([])
+                except WrappedException as ex:
+                    status[0] = "error: " + str(ex).strip().split("\n")[-1]
+                    return
+
+    interpreter.dispatch_stats.reset()
+    stacklet.global_state = stacklet.GlobalState()
+    stacklet.with_stacklets(run)
+    return interpreter.dispatch_stats.calls, interpreter.dispatch_stats.dispatches, status[0]
+
+
+def child(fused, files):
+    import pixie.vm.reader
+    import pixie.vm.compiler as compiler
+    import pixie.vm.interpreter as interpreter
+    import pixie.vm.bytecode_cache as bytecode_cache
+    import pixie.vm.rt as rt
+
+    # compile stdlib with the mode's flags instead of running a cache built with others
+    compiler.USE_SUPERINSTRUCTIONS = fused
+    bytecode_cache.USE_CACHE = False
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        rt.init()
+        interpreter.COUNT_DISPATCHES = True
+        results = [(f, run_benchmark(f)) for f in files]
+    finally:
+        sys.stdout = stdout
+
+    for f, (calls, dispatches, status) in results:
+        print "RESULT %s %d %d %s" % (f, calls, dispatches, status)
+
+
+def main(files):
+    files = files or sorted(glob.glob("benchmarks/*.lisp"))
+    rows = {}
+    for mode in ["plain", "fused"]:
+        out = subprocess.check_output([sys.executable, __file__, "--child", mode] + files)
+        for line in out.splitlines():
+            if not line.startswith("RESULT "):
+                continue
+            f, calls, dispatches, status = line.split(" ", 4)[1:]
+            rows.setdefault(f, {})[mode] = (int(calls), int(dispatches), status)
+
+    print "%-34s %12s %12s %10s %10s %8s" % ("benchmark", "plain", "fused", "plain/call", "fused/call", "saved")
+    for f in sorted(rows):
+        p_calls, p_disp, p_status = rows[f]["plain"]
+        f_calls, f_disp, f_status = rows[f]["fused"]
+        print "%-34s %12d %12d %10.2f %10.2f %7.1f%%" % (f, p_disp, f_disp,
+                                                      p_disp / float(max(p_calls, 1)),
+                                                      f_disp / float(max(f_calls, 1)),
+                                                      100.0 * (p_disp - f_disp) / max(p_disp, 1))
+        if p_status != "ok" or f_status != "ok":
+            print "    (%s)" % (f_status if f_status != "ok" else p_status)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 3 and sys.argv[1] == "--child":
+        child(sys.argv[2] == "fused", sys.argv[3:])
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,12 @@
+(defn add-fn [x]
+  (inc (inc x)))
+
+
+(set-dynamic! (resolve 'user/add-fn))
+
+(set! (resolve 'user/add-fn) inc)
+
+
+(loop [x 0] (if (eq x 10000)
+                x (recur (add-fn x))))
+:exit-repl
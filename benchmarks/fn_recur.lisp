@@ -0,0 +1,5 @@
+((fn [i] (if (eq i 20000000) i (recur (+ i 1)))) 0)
+
+((fn [i acc] (if (eq i 20000000) acc (recur (+ i 1) (-add acc 2)))) 0 0)
+
+:exit-repl
@@ -0,0 +1,69 @@
+"""Measures time to first eval: the time from starting a pixie process until it prints the
+result of evaluating (+ 1 2). Shutting the process down afterwards isn't timed.
+
+    python benchmarks/startup.py [path/to/target-c] [runs]
+
+With a translated binary the stdlib is part of the prebuilt image, so this is mostly process
+start and the REPL. Without one, the untranslated interpreter is timed instead, which includes
+rt.init loading the stdlib (from pixie/stdlib.pxic when that is up to date).
+"""
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+UNTRANSLATED = """
+import sys
+sys.path.insert(0, %r)
+import pixie.vm.reader as reader
+import pixie.vm.rt as rt
+from pixie.vm.compiler import compile, with_ns, NS_VAR
+stdout = sys.stdout
+sys.stdout = open("/dev/null", "w")
+rt.init()
+with with_ns(u"user"):
+    NS_VAR.deref().include_stdlib()
+    result = compile(reader.read(reader.StringReader(u"(+ 1 2)"), True)).invoke([])
+sys.stdout = stdout
+print result.int_val()
+sys.stdout.flush()
+""" % ROOT
+
+
+def run_once(cmd, form, exit_form):
+    start = time.time()
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+    p.stdin.write(form)
+    p.stdin.flush()
+    out = []
+    while True:
+        line = p.stdout.readline()
+        if not line:
+            rest, err = p.communicate()
+            raise Exception("unexpected output from %s:\n%s%s" % (cmd[0], "".join(out), err))
+        out.append(line)
+        if line.rstrip().endswith("3"):
+            elapsed = time.time() - start
+            break
+    p.communicate(exit_form)
+    return elapsed
+
+
+def main():
+    binary = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] else None
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    if binary is None:
+        cmd, form, exit_form, runs = [sys.executable, "-c", UNTRANSLATED], "", "", min(runs, 3)
+    else:
+        cmd, form, exit_form = [os.path.abspath(binary)], "(+ 1 2)\n", ":exit-repl\n"
+
+    times = sorted(run_once(cmd, form, exit_form) for x in range(runs))
+    print "%-40s runs %3d  min %8.1fms  median %8.1fms" % (binary or "untranslated", runs,
+                                                          times[0] * 1000, times[len(times) // 2] * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,18 @@
                i 0]
           (if (= (count acc) 10000)
             acc
-            (recur (conj acc i) (inc i))))]
+            (recur (conj acc i) (inc i))))
+      v (loop [v v
+               i 0]
+          (if (= i 10000)
+            v
+            (recur (assoc v i (* 2 i)) (inc i))))]
   (loop [i 0]
-    (if (= (nth acc i) i)
-      (recur (inc i))
-      (throw "Assert failure")))
-
-  nil)
+    (if (= i 10000)
+      nil
+      (if (= (nth v i) (* 2 i))
+        (recur (inc i))
+        (throw "Assert failure")))))
 
 
 
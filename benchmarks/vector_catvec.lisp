@@ -0,0 +1,23 @@
+(def size 1000000)
+
+(def state (loop [acc (transient [])
+                  i 0]
+             (if (= i size)
+               (persistent! acc)
+               (recur (conj! acc i) (inc i)))))
+
+(loop [v state
+       i 0
+       idx 0]
+  (if (= i 10000)
+    (if (= (count v) size)
+      nil
+      (throw "Assert failure"))
+    (recur (catvec (subvec v idx size) (subvec v 0 idx))
+           (inc i)
+           (let [j (+ idx 7919)]
+             (if (< j size) j (- j size))))))
+
+
+
+:exit-repl
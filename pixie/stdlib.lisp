@@ -14,13 +14,19 @@
            ([result] result)
            ([result item] (-conj result item))))
 
+(def conj! (fn conj!
+            ([] (transient []))
+            ([result] (persistent! result))
+            ([result item] (-conj! result item))))
+
 (def transduce (fn transduce
               ([f coll]
-                (let [result (-reduce coll f (f))]
+                (let [f (if (identical? f conj) conj! f)
+                      result (-reduce coll f (f))]
                       (f result)))
 
               ([xform rf coll]
-                (let [f (xform rf)
+                (let [f (xform (if (identical? rf conj) conj! rf))
                       result (-reduce coll f (f))]
                       (f result)))
               ([xform rf init coll]
@@ -65,14 +71,18 @@
 
 (def seq-reduce (fn seq-reduce
                   [coll f init]
-                  (loop [init init
-                         coll (seq coll)]
-                    (if (reduced? init)
-                      @init
-                      (if (seq coll)
-                        (recur (f init (first coll))
-                               (seq (next coll)))
-                        init)))))
+                  (let [chunk-f (preserving-reduced f)]
+                    (loop [init init
+                           coll (seq coll)]
+                      (if (reduced? init)
+                        @init
+                        (if (seq coll)
+                          (if (chunked-seq? coll)
+                            (recur (-reduce (chunk-first coll) chunk-f init)
+                                   (chunk-rest coll))
+                            (recur (f init (first coll))
+                                   (seq (next coll))))
+                          init))))))
 
 (def indexed-reduce (fn indexed-reduce
                       [coll f init]
@@ -88,6 +98,7 @@
 (extend -reduce Cons seq-reduce)
 (extend -reduce PersistentList seq-reduce)
 (extend -reduce LazySeq seq-reduce)
+(extend -reduce VectorChunkedSeq seq-reduce)
 
 (comment (extend -reduce Array indexed-reduce))
 
@@ -122,6 +133,10 @@
   (fn [v]
     (apply str "[" (conj (transduce (interpose ", ") conj v) "]"))))
 
+(extend -str SubVector
+  (fn [v]
+    (apply str "[" (conj (transduce (interpose ", ") conj v) "]"))))
+
 
 
 
@@ -171,8 +186,8 @@
                               data)))]
           (stacklet->lazy-seq f)))))
 
-(extend -seq PersistentVector sequence)
 (extend -seq Array sequence)
+(extend -seq ArraySlice sequence)
 
 
 
@@ -202,6 +217,26 @@
   ([x y z] (-sub x (-sub y z)))
   ([x y z & rest] (-sub x (-sub y (-sub z (reduce -sub 0 rest))))))
 
+(defn *
+  ([] 1)
+  ([x] x)
+  ([x y] (-mul x y))
+  ([x y & rest] (reduce -mul (-mul x y) rest)))
+
+(defn <
+  ([x] true)
+  ([x y] (-lt x y))
+  ([x y & rest] (if (-lt x y)
+                  (apply < y rest)
+                  false)))
+
+(defn >
+  ([x] true)
+  ([x y] (-gt x y))
+  ([x y & rest] (if (-gt x y)
+                  (apply > y rest)
+                  false)))
+
 (defn =
   ([x] true)
   ([x y] (eq x y))
@@ -347,16 +382,6 @@
         (throw (str "Assert failed " ~msg)))))
 
 
-(defmacro with-bindings [binds & body]
-  `(do (push-binding-frame!)
-       (reduce (fn [_ map-entry]
-                 (set! (resolve (key map-entry)) (val map-entry)))
-               nil
-               (apply hashmap ~binds))
-       (let [ret (do ~@body)]
-         (pop-binding-frame!)
-         ret)))
-
 (def foo 42)
 (set-dynamic! (resolve 'pixie.stdlib/foo))
 
@@ -1,5 +1,6 @@
 import pixie.vm.rt as rt
 import pixie.vm.object as object
+from pixie.vm.object import affirm
 from pixie.vm.code import extend, as_var
 from pixie.vm.numbers import Integer
 from pixie.vm.primitives import nil
@@ -53,6 +54,52 @@ def reduce(self, f, init):
     return self.reduce_small(f, init)
 
 
+class ArraySlice(object.Object):
+    """A read only view of a list from start to end, or to the end of the list when end is -1.
+       Rest args are passed as one of these so they don't have to be copied out of the args list"""
+    _type = object.Type(u"pixie.stdlib.ArraySlice")
+    __immutable_fields__ = ["_list[*]", "_start", "_end"]
+    def type(self):
+        return ArraySlice._type
+
+    def __init__(self, lst, start, end=-1):
+        if end < 0:
+            end = len(lst)
+        assert 0 <= start <= end <= len(lst)
+        self._list = lst
+        self._start = start
+        self._end = end
+
+    def count(self):
+        return self._end - self._start
+
+    def copy_to(self, to_list, to_loc):
+        for x in range(self.count()):
+            to_list[to_loc + x] = self._list[self._start + x]
+
+    def reduce(self, f, init):
+        for x in range(self._start, self._end):
+            if rt.reduced_QMARK_(init):
+                return rt.deref(init)
+            init = f.invoke2(init, self._list[x])
+        return init
+
+
+@extend(proto._count, ArraySlice)
+def _count(self):
+    return rt.wrap(self.count())
+
+@extend(proto._nth, ArraySlice)
+def _nth(self, idx):
+    i = idx.int_val()
+    affirm(0 <= i < self.count(), u"Index out of range")
+    return self._list[self._start + i]
+
+@extend(proto._reduce, ArraySlice)
+def reduce(self, f, init):
+    return self.reduce(f, init)
+
+
 def array(lst):
     assert isinstance(lst, list)
     return Array(lst)
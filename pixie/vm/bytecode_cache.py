@@ -0,0 +1,493 @@
+"""Ahead of time compiled .pxic files.
+
+Loading a source file compiles and runs each top level form in turn, and then writes the
+compiled forms to a .pxic file next to the source. The next load of that file runs the
+cached Code objects instead, as long as the cache is newer than the source and than every
+file loaded before or while it was compiled, was written with the same compiler flags, and
+is loaded from the namespace it was compiled from. A cache file is a header followed by one
+record per top level form:
+
+    header  "PXIC" FORMAT_VERSION len(BYTECODES) flags start-namespace deps
+    record  'R' namespace-name code
+
+The namespace name of a record is empty unless the file itself switched namespaces before
+that form. Values are tagged, see write_obj. Forms whose constants can't be serialized
+(anything a macro spliced in that isn't plain data) mean no cache file is written for that
+source. Bump FORMAT_VERSION whenever the format or the compiler's output changes, the flags
+in compiler_flags are checked on their own."""
+py_object = object
+import os
+import pixie.vm.code as code
+import pixie.vm.numbers as numbers
+import pixie.vm.object as object
+from pixie.vm.primitives import nil, true, false
+from pixie.vm.string import String
+from pixie.vm.keyword import Keyword, keyword
+from pixie.vm.symbol import Symbol, symbol
+from pixie.vm.cons import Cons
+from pixie.vm.persistent_list import PersistentList
+from pixie.vm.persistent_vector import PersistentVector, EMPTY as EMPTY_VECTOR
+from pixie.vm.reader import LinePromise
+from pixie.vm.object import affirm
+from rpython.rlib.rarithmetic import r_uint, intmask, LONG_BIT
+from rpython.rlib.objectmodel import specialize
+import pixie.vm.rt as rt
+
+FORMAT_VERSION = 4
+MAGIC = "PXIC"
+
+# Set to False to always compile from source
+USE_CACHE = True
+
+# Paths of the files loaded so far, in load order. A file compiled now may use macros and
+# vars from any of them, so they are all recorded as its dependencies.
+_loaded_files = []
+
+
+class CacheError(Exception):
+    """Raised when a value can't be written, or a cache file can't be read back"""
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def cache_path_for(path):
+    if path.endswith(".lisp"):
+        stop = len(path) - len(".lisp")
+        assert stop >= 0
+        return path[:stop] + ".pxic"
+    return path + ".pxic"
+
+
+def read_file(path):
+    """Returns the contents of path, or None if it can't be read"""
+    try:
+        fd = os.open(path, os.O_RDONLY, 0777)
+    except OSError:
+        return None
+    try:
+        chunks = []
+        while True:
+            data = os.read(fd, 65536)
+            if len(data) == 0:
+                break
+            chunks.append(data)
+    finally:
+        os.close(fd)
+    return "".join(chunks)
+
+
+def write_file(path, data):
+    """Writes data to path via a temporary file, so readers never see a partial cache.
+       Failures are ignored, the cache is only an optimization."""
+    tmp_path = path + ".tmp"
+    try:
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            pos = 0
+            while pos < len(data):
+                pos += os.write(fd, data[pos:])
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, path)
+    except OSError:
+        pass
+
+
+def is_fresh(cache_path, source_path):
+    try:
+        return os.stat(cache_path).st_mtime > os.stat(source_path).st_mtime
+    except OSError:
+        return False
+
+
+def compiler_flags():
+    """The compiler switches that change what a form compiles to, as a bit set"""
+    import pixie.vm.compiler as compiler
+    flags = 0
+    if compiler.USE_SUPERINSTRUCTIONS:
+        flags |= 1
+    if compiler.OPTIMIZE:
+        flags |= 2
+    if compiler.INTERN_CONSTANTS:
+        flags |= 4
+    if compiler.DIRECT_LINK:
+        flags |= 8
+    return flags
+
+
+class CacheWriter(py_object):
+    def __init__(self):
+        self._chunks = []
+
+    def write_byte(self, b):
+        self._chunks.append(chr(b))
+
+    @specialize.argtype(1)
+    def write_uint(self, x):
+        x = r_uint(x)
+        while x >= 0x80:
+            self._chunks.append(chr(intmask(x & 0x7F) | 0x80))
+            x >>= 7
+        self._chunks.append(chr(intmask(x)))
+
+    def write_int(self, i):
+        # zigzag, so small negative numbers stay small
+        self.write_uint((r_uint(i) << 1) ^ r_uint(i >> (LONG_BIT - 1)))
+
+    def write_bytes(self, data):
+        self.write_uint(len(data))
+        self._chunks.append(data)
+
+    def write_str(self, s):
+        self.write_bytes(s.encode("utf-8"))
+
+    def write_obj(self, o):
+        if o is nil:
+            self.write_byte(ord("n"))
+        elif o is true:
+            self.write_byte(ord("t"))
+        elif o is false:
+            self.write_byte(ord("f"))
+        elif isinstance(o, numbers.Integer):
+            self.write_byte(ord("i"))
+            self.write_int(o.int_val())
+        elif isinstance(o, String):
+            self.write_byte(ord("s"))
+            self.write_str(o._str)
+        elif isinstance(o, Keyword):
+            self.write_byte(ord("k"))
+            self.write_str(o._str)
+        elif isinstance(o, Symbol):
+            self.write_byte(ord("y"))
+            self.write_str(o._str)
+        elif isinstance(o, code.Var):
+            self.write_byte(ord("v"))
+            self.write_str(o._ns)
+            self.write_str(o._name)
+        elif isinstance(o, PersistentList) or isinstance(o, Cons):
+            items = []
+            while o is not nil:
+                items.append(rt.first(o))
+                o = rt.next(o)
+            self.write_byte(ord("l"))
+            self.write_uint(len(items))
+            for x in items:
+                self.write_obj(x)
+        elif isinstance(o, PersistentVector):
+            cnt = rt.count(o).int_val()
+            self.write_byte(ord("w"))
+            self.write_uint(cnt)
+            for x in range(cnt):
+                self.write_obj(rt.nth(o, rt.wrap(x)))
+        elif isinstance(o, code.Code):
+            self.write_byte(ord("c"))
+            self.write_code(o)
+        elif isinstance(o, code.VariadicCode):
+            self.write_byte(ord("a"))
+            self.write_uint(o._required_arity)
+            self.write_obj(o._code)
+        elif isinstance(o, code.MultiArityFn):
+            self.write_byte(ord("m"))
+            self.write_uint(o.get_required_arity())
+            self.write_uint(o.fixed_arity_count())
+            for x in range(o.fixed_arity_count()):
+                self.write_fn_or_none(o.get_fixed_arity(x))
+            self.write_fn_or_none(o.get_rest_fn())
+        else:
+            raise CacheError("can't serialize " + str(o.type()._name.encode("utf-8")))
+
+    def write_fn_or_none(self, f):
+        self.write_obj(nil if f is None else f)
+
+    def write_code(self, c):
+        self.write_str(c._name)
+        self.write_uint(c._stack_size)
+        self.write_uint(len(c._inline_caches))
+
+        bytecode = code.unpack_bytecode(c.get_bytecode())
+        self.write_uint(len(bytecode))
+        for x in bytecode:
+            self.write_uint(x)
+
+        # direct linked consts are written as their vars and linked again when read back
+        consts = c.get_consts()
+        links = c.get_links()
+        self.write_uint(len(consts))
+        for idx in range(len(consts)):
+            self.write_obj(links.get(idx, consts[idx]))
+        self.write_uint(len(links))
+        for idx in links:
+            self.write_uint(idx)
+
+        self.write_uint(len(c._debug_points))
+        for ip in c._debug_points:
+            dp = c._debug_points[ip]
+            if not isinstance(dp, object.InterpreterCodeInfo):
+                raise CacheError("can't serialize debug point")
+            self.write_uint(ip)
+            self.write_str(dp._line.__repr__())
+            self.write_uint(dp._line_number)
+            self.write_uint(dp._column_number)
+            self.write_str(dp._file)
+
+    def to_str(self):
+        return "".join(self._chunks)
+
+
+class CacheReader(py_object):
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+
+    def at_end(self):
+        return self._pos >= len(self._data)
+
+    def read_byte(self):
+        if self._pos >= len(self._data):
+            raise CacheError("truncated cache file")
+        b = ord(self._data[self._pos])
+        self._pos += 1
+        return b
+
+    def read_uint(self):
+        x = r_uint(0)
+        shift = 0
+        while True:
+            b = self.read_byte()
+            x |= r_uint(b & 0x7F) << shift
+            if b < 0x80:
+                return x
+            shift += 7
+
+    def read_int(self):
+        x = self.read_uint()
+        return intmask((x >> 1) ^ (r_uint(0) - (x & 1)))
+
+    def read_bytes(self):
+        size = intmask(self.read_uint())
+        start = self._pos
+        end = start + size
+        if size < 0 or end > len(self._data):
+            raise CacheError("truncated cache file")
+        assert 0 <= start <= end
+        self._pos = end
+        return self._data[start:end]
+
+    def read_str(self):
+        return self.read_bytes().decode("utf-8")
+
+    def read_obj(self):
+        tag = chr(self.read_byte())
+        if tag == "n":
+            return nil
+        if tag == "t":
+            return true
+        if tag == "f":
+            return false
+        if tag == "i":
+            return rt.wrap(self.read_int())
+        if tag == "s":
+            return rt.wrap(self.read_str())
+        if tag == "k":
+            return keyword(self.read_str())
+        if tag == "y":
+            return symbol(self.read_str())
+        if tag == "v":
+            ns = self.read_str()
+            return code.intern_var(ns, self.read_str())
+        if tag == "l":
+            items = [self.read_obj() for x in range(intmask(self.read_uint()))]
+            acc = nil
+            i = r_uint(len(items))
+            while i > 0:
+                acc = PersistentList(items[i - 1], acc, len(items) - i + 1, nil)
+                i -= 1
+            return acc
+        if tag == "w":
+            acc = EMPTY_VECTOR
+            for x in range(intmask(self.read_uint())):
+                acc = acc.conj(self.read_obj())
+            return acc
+        if tag == "c":
+            return self.read_code()
+        if tag == "a":
+            required_arity = self.read_uint()
+            return code.VariadicCode(self.read_code_obj(), required_arity)
+        if tag == "m":
+            required_arity = intmask(self.read_uint())
+            arities = [self.read_fn_or_none() for x in range(intmask(self.read_uint()))]
+            return code.MultiArityFn(arities, required_arity, self.read_fn_or_none())
+        raise CacheError("unknown tag in cache file")
+
+    def read_code_obj(self):
+        o = self.read_obj()
+        if not isinstance(o, code.Code):
+            raise CacheError("expected code in cache file")
+        return o
+
+    def read_fn_or_none(self):
+        o = self.read_obj()
+        if o is nil:
+            return None
+        if not isinstance(o, code.BaseCode):
+            raise CacheError("expected a fn in cache file")
+        return o
+
+    def read_code(self):
+        name = self.read_str()
+        stack_size = intmask(self.read_uint())
+        inline_cache_count = intmask(self.read_uint())
+        bytecode = [self.read_uint() for x in range(intmask(self.read_uint()))]
+        consts = [self.read_obj() for x in range(intmask(self.read_uint()))]
+        links = {}
+        for x in range(intmask(self.read_uint())):
+            idx = intmask(self.read_uint())
+            if idx < 0 or idx >= len(consts):
+                raise CacheError("bad link in cache file")
+            var = consts[idx]
+            if not isinstance(var, code.Var):
+                raise CacheError("bad link in cache file")
+            links[idx] = var
+
+        debug_points = {}
+        for x in range(intmask(self.read_uint())):
+            ip = intmask(self.read_uint())
+            line = LinePromise()
+            line._str = self.read_str()
+            line._chrs = None
+            line_number = intmask(self.read_uint())
+            column_number = intmask(self.read_uint())
+            debug_points[ip] = object.InterpreterCodeInfo(line, line_number, column_number, self.read_str())
+
+        return code.Code(name, bytecode, consts, stack_size, debug_points, inline_cache_count, links)
+
+
+class Record(py_object):
+    """A compiled top level form, and the namespace the file switched to before it, or None
+       if it runs in the same namespace as the form before it"""
+    def __init__(self, ns, code_obj):
+        self.ns = ns
+        self.code_obj = code_obj
+
+
+class CacheFile(py_object):
+    """The decoded contents of a .pxic file"""
+    def __init__(self, flags, start_ns, deps, records):
+        self.flags = flags
+        self.start_ns = start_ns
+        self.deps = deps
+        self.records = records
+
+    def is_usable(self, cache_path, ns):
+        """True if running the records from ns does what compiling the source would"""
+        if self.flags != compiler_flags() or self.start_ns != ns:
+            return False
+        for dep in self.deps:
+            if not is_fresh(cache_path, dep):
+                return False
+        return True
+
+
+def encode_records(start_ns, deps, records):
+    w = CacheWriter()
+    for x in MAGIC:
+        w.write_byte(ord(x))
+    w.write_uint(FORMAT_VERSION)
+    w.write_uint(len(code.BYTECODES))
+    w.write_uint(compiler_flags())
+    w.write_str(start_ns)
+    w.write_uint(len(deps))
+    for dep in deps:
+        w.write_bytes(dep)
+    for record in records:
+        w.write_byte(ord("R"))
+        w.write_str(u"" if record.ns is None else record.ns)
+        w.write_code(record.code_obj)
+    return w.to_str()
+
+
+def decode_records(data):
+    r = CacheReader(data)
+    for x in MAGIC:
+        if r.read_byte() != ord(x):
+            raise CacheError("not a cache file")
+    if r.read_uint() != FORMAT_VERSION or r.read_uint() != len(code.BYTECODES):
+        raise CacheError("cache file is from another version")
+    flags = intmask(r.read_uint())
+    start_ns = r.read_str()
+    deps = [r.read_bytes() for x in range(intmask(r.read_uint()))]
+
+    records = []
+    while not r.at_end():
+        if r.read_byte() != ord("R"):
+            raise CacheError("bad record")
+        ns = r.read_str()
+        records.append(Record(None if ns == u"" else ns, r.read_code()))
+    return CacheFile(flags, start_ns, deps, records)
+
+
+def run_records(records, after_form):
+    from pixie.vm.compiler import NS_VAR
+    result = nil
+    for record in records:
+        if record.ns is not None:
+            NS_VAR.set_value(code._ns_registry.find_or_make(record.ns))
+            NS_VAR.deref().include_stdlib()
+        result = record.code_obj.invoke([])
+        if after_form is not None:
+            after_form()
+    return result
+
+
+def compile_file(path, cache_path, after_form):
+    from pixie.vm.compiler import compile, NS_VAR
+    from pixie.vm.reader import read, eof, MetaDataReader, StringReader
+
+    data = read_file(path)
+    affirm(data is not None, u"Can't read " + unicode(path))
+    rdr = MetaDataReader(StringReader(data.decode("utf-8")), unicode(path))
+
+    start_ns = NS_VAR.deref()._name
+    ns = start_ns
+    records = []
+    result = nil
+    while True:
+        form = read(rdr, False)
+        if form is eof:
+            break
+        code_obj = compile(form)
+        if NS_VAR.deref()._name == ns:
+            records.append(Record(None, code_obj))
+        else:
+            ns = NS_VAR.deref()._name
+            records.append(Record(ns, code_obj))
+        result = code_obj.invoke([])
+        if after_form is not None:
+            after_form()
+
+    if USE_CACHE:
+        deps = [dep for dep in _loaded_files if dep != path]
+        try:
+            write_file(cache_path, encode_records(start_ns, deps, records))
+        except CacheError:
+            pass
+    return result
+
+
+def load_file(path, after_form=None):
+    """Compiles and runs the forms in the file at path, or runs them from its .pxic cache if
+       that is still usable. after_form is called after each top level form."""
+    if path not in _loaded_files:
+        _loaded_files.append(path)
+    cache_path = cache_path_for(path)
+    if USE_CACHE and is_fresh(cache_path, path):
+        data = read_file(cache_path)
+        if data is not None:
+            from pixie.vm.compiler import NS_VAR
+            try:
+                cache = decode_records(data)
+            except CacheError:
+                cache = None
+            if cache is not None and cache.is_usable(cache_path, NS_VAR.deref()._name):
+                return run_records(cache.records, after_form)
+    return compile_file(path, cache_path, after_form)
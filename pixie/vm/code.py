@@ -2,10 +2,11 @@ py_object = object
 import pixie.vm.object as object
 from pixie.vm.object import affirm
 from pixie.vm.primitives import nil, true, false
-from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rarithmetic import r_uint, intmask
 from rpython.rlib.jit import elidable, elidable_promote, promote
 import rpython.rlib.jit as jit
 import pixie.vm.rt as rt
+import weakref
 
 
 BYTECODES = ["LOAD_CONST",
@@ -29,12 +30,56 @@ BYTECODES = ["LOAD_CONST",
              "PUSH_SELF",
              "POP_UP_N",
              "MAKE_MULTI_ARITY",
-             "MAKE_VARIADIC"]
+             "MAKE_VARIADIC",
+             "LOAD_VAR_VALUE",
+             "INVOKE_VAR",
+             "ARG_COND_BR",
+             "DUP_NTH_COND_BR",
+             "SUB",
+             "MUL",
+             "LT",
+             "GT",
+             "NUM_EQ",
+             "PUSH_BINDINGS",
+             "POP_BINDINGS"]
 
 for x in range(len(BYTECODES)):
     globals()[BYTECODES[x]] = r_uint(x)
 
 
+def pack_bytecode(bytecode):
+    """Packs a list of opcodes and operands into a string of little endian 16 bit units, or
+       32 bit units if an operand doesn't fit in 16. The first byte holds the unit width."""
+    width = 2
+    for x in bytecode:
+        if x > 0xFFFF:
+            width = 4
+            break
+
+    chars = [chr(width)]
+    for x in bytecode:
+        x = r_uint(x)
+        for b in range(width):
+            chars.append(chr(intmask((x >> (b * 8)) & 0xFF)))
+    return "".join(chars)
+
+@elidable
+def bytecode_at(packed, idx):
+    width = ord(packed[0])
+    pos = 1 + intmask(idx) * width
+    val = r_uint(ord(packed[pos])) | (r_uint(ord(packed[pos + 1])) << 8)
+    if width == 4:
+        val |= (r_uint(ord(packed[pos + 2])) << 16) | (r_uint(ord(packed[pos + 3])) << 24)
+    return val
+
+@elidable
+def bytecode_len(packed):
+    return r_uint((len(packed) - 1) // ord(packed[0]))
+
+def unpack_bytecode(packed):
+    return [bytecode_at(packed, r_uint(x)) for x in range(bytecode_len(packed))]
+
+
 @jit.unroll_safe
 def resize_list(lst, new_size):
     """'Resizes' a list, via reallocation and copy"""
@@ -72,17 +117,6 @@ def slice_from_start(from_list, count, extra=r_uint(0)):
     list_copy(from_list, 0, new_lst, 0, count)
     return new_lst
 
-# class TailCall(object.Object):
-#     _type = object.Type("TailCall")
-#     __immutable_fields_ = ["_f", "_args"]
-#     def __init__(self, f, args):
-#         self._f = f
-#         self._args = args
-#
-#     def run(self):
-#         return self._f._invoke(self._args)
-
-
 class BaseCode(object.Object):
     def __init__(self):
         self._is_macro = False
@@ -106,37 +140,98 @@ class BaseCode(object.Object):
     def stack_size(self):
         return 0
 
+    def get_debug_point(self, ip):
+        return None
+
+    def get_inline_cache(self, idx):
+        raise NotImplementedError()
+
     def invoke(self, args):
+        """Calls this code with args. The callee owns the args list, interpreted code
+           rebinds it in place on recur, so callers must not reuse it."""
         result = self._invoke(args)
         return result
 
+    # Fixed-arity entry points, override these to avoid allocating an args list per call
+
+    def invoke0(self):
+        return self.invoke([])
+
+    def invoke1(self, a):
+        return self.invoke([a])
+
+    def invoke2(self, a, b):
+        return self.invoke([a, b])
+
+    def invoke3(self, a, b, c):
+        return self.invoke([a, b, c])
+
+    # Used by rt's direct entry points. Native fns override these to skip adding themselves
+    # to the trace of an exception on the way out.
+
+    def raw_invoke1(self, a):
+        return self.invoke1(a)
+
+    def raw_invoke2(self, a, b):
+        return self.invoke2(a, b)
+
+    def raw_invoke3(self, a, b, c):
+        return self.invoke3(a, b, c)
+
 
 class MultiArityFn(BaseCode):
     _type = object.Type(u"pixie.stdlib.MultiArityFn")
 
-    _immutable_fields_ = ["_arities[*]", "_required_arity", "_rest_fn"]
+    _immutable_fields_ = ["_arities[*]", "_required_arity"]
 
     def type(self):
         return MultiArityFn._type
 
     def __init__(self, arities, required_arity=0, rest_fn=None):
+        """arities holds the fn for each argc, or None. The rest fn goes in a slot at the end."""
         BaseCode.__init__(self)
-        self._arities = arities
+        self._arities = arities + [rest_fn]
         self._required_arity = required_arity
-        self._rest_fn = rest_fn
+
+    def fixed_arity_count(self):
+        return len(self._arities) - 1
+
+    def get_fixed_arity(self, argc):
+        return self._arities[argc]
+
+    def get_rest_fn(self):
+        return self._arities[len(self._arities) - 1]
+
+    def get_required_arity(self):
+        return self._required_arity
 
     @elidable_promote()
     def get_fn(self, arity):
-        f = self._arities.get(arity, None)
-        if f is not None:
-            return f
-        if self._rest_fn is not None and arity >= self._required_arity:
-            return self._rest_fn
+        rest_idx = len(self._arities) - 1
+        if arity < rest_idx:
+            f = self._arities[arity]
+            if f is not None:
+                return f
+        rest_fn = self._arities[rest_idx]
+        if rest_fn is not None and arity >= self._required_arity:
+            return rest_fn
         affirm(False, u"Wrong number of args to fn")
 
     def _invoke(self, args):
         return self.get_fn(len(args)).invoke(args)
 
+    def invoke0(self):
+        return self.get_fn(0).invoke0()
+
+    def invoke1(self, a):
+        return self.get_fn(1).invoke1(a)
+
+    def invoke2(self, a, b):
+        return self.get_fn(2).invoke2(a, b)
+
+    def invoke3(self, a, b, c):
+        return self.get_fn(3).invoke3(a, b, c)
+
 
 
 
@@ -157,24 +252,111 @@ class NativeFn(BaseCode):
         raise NotImplementedError()
 
 
+INLINE_CACHE_SIZE = 4
+
+class InlineCache(py_object):
+    """Caches protocol dispatch at a single call site. Holds up to INLINE_CACHE_SIZE
+       (fn, type, type, rev) -> target entries, a site that sees more than that is megamorphic
+       and just does the lookup."""
+    def __init__(self):
+        self._fns = [None] * INLINE_CACHE_SIZE
+        self._tp1s = [None] * INLINE_CACHE_SIZE
+        self._tp2s = [None] * INLINE_CACHE_SIZE
+        self._revs = [0] * INLINE_CACHE_SIZE
+        self._targets = [None] * INLINE_CACHE_SIZE
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, fn, a, b):
+        """Returns the fn to call at this site for the given first and second args (b may be
+           None), fn itself if it isn't protocol dispatched."""
+        if isinstance(fn, PolymorphicFn):
+            tp1 = a.type()
+            tp2 = None
+            rev = fn._rev
+        elif isinstance(fn, DoublePolymorphicFn) and b is not None:
+            tp1 = a.type()
+            tp2 = b.type()
+            rev = fn._rev
+        else:
+            return fn
+
+        i = 0
+        while i < self._count:
+            if self._fns[i] is fn and self._tp1s[i] is tp1 and self._tp2s[i] is tp2:
+                if self._revs[i] == rev:
+                    self.hits += 1
+                    return self._targets[i]
+                break
+            i += 1
+
+        self.misses += 1
+        if isinstance(fn, PolymorphicFn):
+            target = fn.get_protocol_fn(tp1, rev)
+        else:
+            assert isinstance(fn, DoublePolymorphicFn)
+            target = fn.get_fn(tp1, tp2, rev)
+
+        if i == self._count:
+            if i == INLINE_CACHE_SIZE:
+                return target
+            self._count += 1
+        self._fns[i] = fn
+        self._tp1s[i] = tp1
+        self._tp2s[i] = tp2
+        self._revs[i] = rev
+        self._targets[i] = target
+        return target
+
+
 class Code(BaseCode):
     """Interpreted code block. Contains consts and """
     _type = object.Type(u"Code")
-    __immutable_fields__ = ["_consts[*]", "_bytecode", "_stack_size"]
+    __immutable_fields__ = ["_consts?[*]", "_bytecode", "_stack_size", "_inline_caches[*]"]
 
     def type(self):
         return Code._type
 
-    def __init__(self, name, bytecode, consts, stack_size, debug_points):
+    def __init__(self, name, bytecode, consts, stack_size, debug_points, inline_cache_count=0,
+                 links=None):
         BaseCode.__init__(self)
-        self._bytecode = bytecode
+        self._bytecode = pack_bytecode(bytecode)
         self._consts = consts
         self._name = name
         self._stack_size = stack_size
         self._debug_points = debug_points
+        self._inline_caches = [InlineCache() for x in range(inline_cache_count)]
+        self._links = {}
+        if links is not None:
+            for idx in links:
+                self.link_var(idx, links[idx])
+
+    def link_var(self, idx, var):
+        """Makes the const at idx the root of var (direct linking). The const is replaced
+           when var is redefined, and becomes var itself once var can't be linked."""
+        self._links[idx] = var
+        self._consts[idx] = var.link_value(self)
+
+    def relink_var(self, var):
+        consts = self._consts[:]
+        for idx in self._links:
+            if self._links[idx] is var:
+                consts[idx] = var.link_value(self)
+        # a new list, so the JIT notices the quasi-immutable field changed
+        self._consts = consts
+
+    def get_links(self):
+        return self._links
 
     def get_debug_point(self, ip):
-        return self._debug_points.get(ip, None)
+        return self._debug_points.get(intmask(ip), None)
+
+    def get_inline_caches(self):
+        return self._inline_caches
+
+    def get_inline_cache(self, idx):
+        return self._inline_caches[idx]
 
     def _invoke(self, args):
         try:
@@ -183,12 +365,13 @@ class Code(BaseCode):
             ex._ex._trace.append(object.PixieCodeInfo(self._name))
             raise
 
-    @elidable_promote()
     def get_consts(self):
+        self = promote(self)
         return self._consts
 
     @elidable_promote()
     def get_bytecode(self):
+        """Returns the packed bytecode, see pack_bytecode"""
         return self._bytecode
 
     @elidable_promote()
@@ -213,22 +396,26 @@ class VariadicCode(BaseCode):
         self._required_arity = r_uint(required_arity)
         self._code = code
 
-    def _invoke(self, args):
-        from pixie.vm.array import array
+    def pack_args(self, args):
+        """Returns the args for the wrapped code, with everything past the required arity packed
+           into an array, or an ArraySlice over args when there are required args"""
+        from pixie.vm.array import array, ArraySlice
         argc = len(args)
         if self._required_arity == 0:
-            return self._code.invoke([array(args)])
+            return [array(args)]
         if argc == self._required_arity:
             new_args = resize_list(args, len(args) + 1)
             new_args[len(args)] = array([])
-            return self._code.invoke(new_args)
+            return new_args
         elif argc > self._required_arity:
             start = slice_from_start(args, self._required_arity, 1)
-            rest = slice_to_end(args, self._required_arity)
-            start[self._required_arity] = array(rest)
-            return self._code.invoke(start)
+            start[self._required_arity] = ArraySlice(args, intmask(self._required_arity))
+            return start
         affirm(False, u"Got " + unicode(str(argc)) + u" arg(s) need at least " + unicode(str(self._required_arity)))
 
+    def _invoke(self, args):
+        return self._code.invoke(self.pack_args(args))
+
 class Closure(BaseCode):
     _type = object.Type(u"Closure")
     __immutable_fields__ = ["_closed_overs[*]", "_code"]
@@ -269,6 +456,12 @@ class Closure(BaseCode):
     def get_debug_point(self, idx):
         return self._code.get_debug_point(idx)
 
+    def get_inline_caches(self):
+        return self._code.get_inline_caches()
+
+    def get_inline_cache(self, idx):
+        return self._code.get_inline_cache(idx)
+
 class Undefined(object.Object):
     _type = object.Type(u"Undefined")
 
@@ -277,24 +470,61 @@ class Undefined(object.Object):
 
 undefined = Undefined()
 
+class BindingFrame(py_object):
+    """One level of dynamic bindings, holding only the vars set at this level. Lookups
+       that miss fall through to the parent frame."""
+    def __init__(self, parent):
+        self._parent = parent
+        self._bindings = {}
+
 class DynamicVars(py_object):
+    """A stack of linked BindingFrames, pushing and popping doesn't copy any bindings. Each
+       var caches the value it last looked up along with the frame that was on top at the
+       time, so repeated derefs under the same frame don't walk the chain."""
     def __init__(self):
-        self._vars = [{}]
+        self._top = BindingFrame(None)
 
     def push_binding_frame(self):
-        self._vars.append(self._vars[-1].copy())
+        self._top = BindingFrame(self._top)
 
     def pop_binding_frame(self):
-        self._vars.pop()
+        affirm(self._top._parent is not None, u"Can't pop the root binding frame")
+        self._top = self._top._parent
+
+    def top(self):
+        return self._top
+
+    def unwind_to(self, frame):
+        """Drops the frames pushed on top of frame, for when an exception unwinds past them"""
+        self._top = frame
 
     def get_var_value(self, var, not_found):
-        return self._vars[-1].get(var, not_found)
+        top = self._top
+        if var._binding_frame is not top:
+            val = None
+            frame = top
+            while frame is not None:
+                val = frame._bindings.get(var, None)
+                if val is not None:
+                    break
+                frame = frame._parent
+            var._binding_frame = top
+            var._binding_value = val
+
+        val = var._binding_value
+        return not_found if val is None else val
 
     def set_var_value(self, var, val):
-        self._vars[-1][var] = val
+        self._top._bindings[var] = val
+        var._binding_frame = self._top
+        var._binding_value = val
 
 _dynamic_vars = DynamicVars()
 
+# While rt.init loads the stdlib this is a list, and vars add themselves to it as their root is
+# set, so rt only has to look at newly defined vars after each form. None the rest of the time.
+_defined_vars_log = None
+
 class Var(BaseCode):
     _type = object.Type(u"Var")
     _immutable_fields_ = ["_rev?"]
@@ -308,12 +538,54 @@ class Var(BaseCode):
         self._rev = 0
         self._root = undefined
         self._dynamic = False
+        self._binding_frame = None
+        self._binding_value = None
+        self._dependents = []
+        self._dependents_limit = 8
 
     def set_root(self, o):
         self._rev += 1
         self._root = o
+        if _defined_vars_log is not None:
+            _defined_vars_log.append(self)
+        self.relink_dependents()
         return self
 
+    def is_linkable(self):
+        """True if code may embed the root of this var instead of dereferencing it"""
+        return not self._dynamic and isinstance(self._root, BaseCode)
+
+    def link_value(self, code_obj):
+        """The const code_obj should hold for this var, registers code_obj to be relinked
+           if the var changes. Only a weak reference is kept, so linked code compiled at the
+           REPL or by eval can still be freed."""
+        if not self.is_linkable():
+            return self
+        dependents = self._dependents
+        # code links all its consts for this var in one go, so a repeat is always the last
+        if len(dependents) == 0 or dependents[-1]() is not code_obj:
+            if len(dependents) >= self._dependents_limit:
+                self.prune_dependents()
+            self._dependents.append(weakref.ref(code_obj))
+        return self._root
+
+    def prune_dependents(self):
+        """Drops the references to freed code, the limit doubles so this stays amortized O(1)"""
+        alive = [ref for ref in self._dependents if ref() is not None]
+        self._dependents = alive
+        self._dependents_limit = 2 * len(alive) + 8
+
+    def relink_dependents(self):
+        if len(self._dependents) == 0:
+            return
+        dependents = self._dependents
+        self._dependents = []
+        self._dependents_limit = 8
+        for ref in dependents:
+            code_obj = ref()
+            if code_obj is not None:
+                code_obj.relink_var(self)
+
     def set_value(self, val):
         affirm(self._dynamic, u"Can't set the value of a non-dynamic var")
         _dynamic_vars.set_var_value(self, val)
@@ -323,6 +595,7 @@ class Var(BaseCode):
     def set_dynamic(self):
         self._dynamic = True
         self._rev += 1
+        self.relink_dependents()
 
     def get_dynamic_value(self):
         return _dynamic_vars.get_var_value(self, self._root)
@@ -350,6 +623,18 @@ class Var(BaseCode):
     def _invoke(self, args):
         return self.deref().invoke(args)
 
+    def invoke0(self):
+        return self.deref().invoke0()
+
+    def invoke1(self, a):
+        return self.deref().invoke1(a)
+
+    def invoke2(self, a, b):
+        return self.deref().invoke2(a, b)
+
+    def invoke3(self, a, b, c):
+        return self.deref().invoke3(a, b, c)
+
 class bindings(py_object):
     def __init__(self, *args):
        self._args = args
@@ -381,6 +666,10 @@ class Namespace(object.Object):
         self._registry = {}
         self._name = name
         self._refers = {}
+        self._direct_link = False
+        # symbol string -> var for symbols resolved through this namespace. Only hits are
+        # cached, interning a var here or adding a refer can change them so both clear it.
+        self._resolve_cache = {}
 
     def intern_or_make(self, name):
         assert name is not None
@@ -389,6 +678,7 @@ class Namespace(object.Object):
         if v is None:
             v = Var(self._name, name)
             self._registry[name] = v
+            self._resolve_cache = {}
         return v
 
     def add_refer(self, ns, as_nm=None, refer_all=False):
@@ -396,14 +686,23 @@ class Namespace(object.Object):
             as_nm = ns._name
 
         self._refers[as_nm] = Refer(ns, refer_all=refer_all)
+        self._resolve_cache = {}
 
     def include_stdlib(self):
         stdlib = _ns_registry.find_or_make(u"pixie.stdlib")
         self.add_refer(stdlib, refer_all=True)
 
-    def resolve(self, s, use_refers=True):
+    def resolve(self, s):
         import pixie.vm.symbol as symbol
         affirm(isinstance(s, symbol.Symbol), u"Must resolve symbols")
+        var = self._resolve_cache.get(s._str, None)
+        if var is None:
+            var = self._resolve(s)
+            if var is not None:
+                self._resolve_cache[s._str] = var
+        return var
+
+    def _resolve(self, s):
         ns = rt.namespace(s)
         name = rt.name(s)
 
@@ -420,11 +719,11 @@ class Namespace(object.Object):
             resolved_ns = self
 
         var = resolved_ns._registry.get(name, None)
-        if var is None and use_refers:
+        if var is None:
             for refer_nm in self._refers:
                 refer = self._refers[refer_nm]
                 if name in refer._refer_syms or refer._refer_all:
-                    var = refer._namespace.resolve(symbol.Symbol(name), False)
+                    var = refer._namespace.get(name, None)
                 if var is not None:
                     return var
             return None
@@ -546,6 +845,30 @@ class PolymorphicFn(BaseCode):
             ex._ex._trace.append(object.PolymorphicCodeInfo(self._name, args[0].type()))
             raise
 
+    def invoke1(self, a):
+        fn = self.get_protocol_fn(a.type(), self._rev)
+        try:
+            return fn.invoke1(a)
+        except object.WrappedException as ex:
+            ex._ex._trace.append(object.PolymorphicCodeInfo(self._name, a.type()))
+            raise
+
+    def invoke2(self, a, b):
+        fn = self.get_protocol_fn(a.type(), self._rev)
+        try:
+            return fn.invoke2(a, b)
+        except object.WrappedException as ex:
+            ex._ex._trace.append(object.PolymorphicCodeInfo(self._name, a.type()))
+            raise
+
+    def invoke3(self, a, b, c):
+        fn = self.get_protocol_fn(a.type(), self._rev)
+        try:
+            return fn.invoke3(a, b, c)
+        except object.WrappedException as ex:
+            ex._ex._trace.append(object.PolymorphicCodeInfo(self._name, a.type()))
+            raise
+
 class DoublePolymorphicFn(BaseCode):
     """A function that is polymorphic on the first two arguments"""
     _type = object.Type(u"DoublePolymorphicFn")
@@ -591,6 +914,12 @@ class DoublePolymorphicFn(BaseCode):
         fn = self.get_fn(a, b, self._rev)
         return fn.invoke(args)
 
+    def invoke2(self, a, b):
+        return self.get_fn(a.type(), b.type(), self._rev).invoke2(a, b)
+
+    def invoke3(self, a, b, c):
+        return self.get_fn(a.type(), b.type(), self._rev).invoke3(a, b, c)
+
 def munge(s):
     return s.replace("-", "_").replace("?", "_QMARK_").replace("!", "_BANG_")
 
@@ -620,8 +949,13 @@ def assert_type(x, tp):
 CO_VARARGS = 0x4
 def wrap_fn(fn, tp=object.Object):
     """Converts a native Python function into a pixie function."""
-    def as_native_fn(f):
-        return type("W"+fn.__name__, (NativeFn,), {"inner_invoke": f})()
+    def as_native_fn(f, fixed=None, raw=None):
+        members = {"inner_invoke": f}
+        if fixed is not None:
+            members["invoke" + str(argc)] = fixed
+        if raw is not None:
+            members["raw_invoke" + str(argc)] = raw
+        return type("W"+fn.__name__, (NativeFn,), members)()
 
     def as_variadic_fn(f):
         return type("W"+fn.__name__[:len("__args")], (NativeFn,), {"inner_invoke": f})()
@@ -643,7 +977,13 @@ def wrap_fn(fn, tp=object.Object):
                 except object.WrappedException as ex:
                     ex._ex._trace.append(object.NativeCodeInfo(fn_name))
                     raise
-            return as_native_fn(wrapped_fn)
+            def fixed_fn(self):
+                try:
+                    return fn()
+                except object.WrappedException as ex:
+                    ex._ex._trace.append(object.NativeCodeInfo(fn_name))
+                    raise
+            return as_native_fn(wrapped_fn, fixed_fn)
 
         if argc == 1:
             def wrapped_fn(self, args):
@@ -652,7 +992,15 @@ def wrap_fn(fn, tp=object.Object):
                 except object.WrappedException as ex:
                     ex._ex._trace.append(object.NativeCodeInfo(fn_name))
                     raise
-            return as_native_fn(wrapped_fn)
+            def fixed_fn(self, a):
+                try:
+                    return fn(a)
+                except object.WrappedException as ex:
+                    ex._ex._trace.append(object.NativeCodeInfo(fn_name))
+                    raise
+            def raw_fn(self, a):
+                return fn(a)
+            return as_native_fn(wrapped_fn, fixed_fn, raw_fn)
 
         if argc == 2:
             def wrapped_fn(self, args):
@@ -661,7 +1009,15 @@ def wrap_fn(fn, tp=object.Object):
                 except object.WrappedException as ex:
                     ex._ex._trace.append(object.NativeCodeInfo(fn_name))
                     raise
-            return as_native_fn(wrapped_fn)
+            def fixed_fn(self, a, b):
+                try:
+                    return fn(a, b)
+                except object.WrappedException as ex:
+                    ex._ex._trace.append(object.NativeCodeInfo(fn_name))
+                    raise
+            def raw_fn(self, a, b):
+                return fn(a, b)
+            return as_native_fn(wrapped_fn, fixed_fn, raw_fn)
         if argc == 3:
             def wrapped_fn(self, args):
                 try:
@@ -669,7 +1025,15 @@ def wrap_fn(fn, tp=object.Object):
                 except object.WrappedException as ex:
                     ex._ex._trace.append(object.NativeCodeInfo(fn_name))
                     raise
-            return as_native_fn(wrapped_fn)
+            def fixed_fn(self, a, b, c):
+                try:
+                    return fn(a, b, c)
+                except object.WrappedException as ex:
+                    ex._ex._trace.append(object.NativeCodeInfo(fn_name))
+                    raise
+            def raw_fn(self, a, b, c):
+                return fn(a, b, c)
+            return as_native_fn(wrapped_fn, fixed_fn, raw_fn)
 
 
 def extend(pfn, tp1, tp2=None):
@@ -718,6 +1082,5 @@ def returns(type):
     """Tags a var as for unwrapping in rt. When rt imports this var it will be automatically converted to this type"""
     def with_fn(fn):
         fn._returns = type
-        print "registered", fn
         return fn
     return with_fn
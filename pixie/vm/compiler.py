@@ -5,6 +5,7 @@ import pixie.vm.numbers as numbers
 from pixie.vm.cons import cons, Cons
 import pixie.vm.symbol as symbol
 import pixie.vm.code as code
+import pixie.vm.optimizer as optimizer
 from pixie.vm.keyword import Keyword
 from pixie.vm.string import String
 import pixie.vm.protocols as proto
@@ -12,6 +13,7 @@ from rpython.rlib.rarithmetic import r_uint
 
 import pixie.vm.rt as rt
 from pixie.vm.util import *
+from pixie.vm.code import as_var
 
 NS_VAR = code.intern_var(u"pixie.stdlib", u"*ns*")
 NS_VAR.set_dynamic()
@@ -30,30 +32,73 @@ class with_ns(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         code._dynamic_vars.pop_binding_frame()
 
-def clone(lst):
-    arr = [None] * len(lst)
-    i = 0
-    while i < len(lst):
-        arr[i] = lst[i]
-        i += 1
+# Fuse common opcode sequences (LOAD_CONST + DEREF_VAR, var calls, branches on locals)
+# into single instructions. Only turned off to measure the difference.
+USE_SUPERINSTRUCTIONS = True
 
-    return arr
+# Run the peephole and dead code pass (see optimizer.py) before building Code objects
+OPTIMIZE = True
 
+# Share equal Integer and String constants between all compiled code
+INTERN_CONSTANTS = True
+
+# Call the roots of non-dynamic vars directly instead of dereferencing the var on each call,
+# in every namespace. See set-direct-linking! to turn this on for a single namespace.
+DIRECT_LINK = False
+
+class ConstantInterner(object):
+    """Image wide table of immutable constants, so equal literals compiled into different
+       Code objects end up as the same object"""
+    def __init__(self):
+        self._ints = {}
+        self._strs = {}
+
+    def intern(self, v):
+        if isinstance(v, numbers.Integer):
+            found = self._ints.get(v.int_val(), None)
+            if found is None:
+                self._ints[v.int_val()] = v
+                return v
+            return found
+        if isinstance(v, String):
+            found = self._strs.get(v._str, None)
+            if found is None:
+                self._strs[v._str] = v
+                return v
+            return found
+        return v
+
+_interner = ConstantInterner()
+
+
+
+class Scope(object):
+    """One local binding in a persistent chain, inner bindings shadow the outer ones"""
+    def __init__(self, name, local, parent):
+        self.name = name
+        self.local = local
+        self.parent = parent
+
+    def lookup(self, name):
+        scope = self
+        while scope is not None:
+            if scope.name == name:
+                return scope.local
+            scope = scope.parent
+        return None
 
 
 class Context(object):
     def __init__(self, name, argc, parent_ctx):
         if parent_ctx is not None:
             affirm(isinstance(parent_ctx, Context), u"Parent Context must be a Context")
-            locals = parent_ctx.locals[-1].copy()
-            for x in locals:
-                locals[x] = Closure(locals[x], parent_ctx)
-        else:
-            locals = {}
 
         self.bytecode = []
         self.consts = []
-        self.locals = [locals]
+        self._const_index = {}
+        self.parent_ctx = parent_ctx
+        self.scope = None
+        self._closure_index = {}
         self._sp = r_uint(0)
         self._max_sp = 0
         self.can_tail_call = False
@@ -61,6 +106,8 @@ class Context(object):
         self.name = name
         self.recur_points = []
         self.debug_points = {}
+        self.inline_cache_count = 0
+        self.links = {}
 
     def sp(self):
         return self._sp
@@ -86,7 +133,23 @@ class Context(object):
         self.recur_points.pop()
 
     def to_code(self, required_args=-1):
-        return code.Code(self.name, self.bytecode, clone(self.consts), self._max_sp + 1, self.debug_points)
+        if OPTIMIZE:
+            bytecode, debug_points, stack_size = optimizer.optimize(self.bytecode, self.consts, self.debug_points)
+        else:
+            bytecode, debug_points, stack_size = self.bytecode, self.debug_points, self._max_sp + 1
+        return code.Code(self.name, bytecode, self.consts[:], stack_size, debug_points,
+                         self.inline_cache_count, self.links)
+
+    def add_inline_cache(self):
+        """Allocates an inline cache for a call site, returns its index"""
+        self.inline_cache_count += 1
+        return r_uint(self.inline_cache_count - 1)
+
+    def emit_invoke(self, argc):
+        """Emits INVOKE for argc stack values (the fn and its args) with a fresh inline cache"""
+        self.bytecode.append(code.INVOKE)
+        self.bytecode.append(r_uint(argc))
+        self.bytecode.append(self.add_inline_cache())
 
     def push_arg(self, idx):
         self.bytecode.append(code.ARG)
@@ -95,37 +158,44 @@ class Context(object):
 
 
     def add_local(self, name, arg):
-        self.locals.append(self.locals[-1].copy())
-        self.locals[-1][name] = arg
+        self.scope = Scope(name, arg, self.scope)
 
 
     def get_local(self, s_name):
-        local = self.locals[-1].get(s_name, None)
-        if local is not None and isinstance(local, Closure):
-            idx = 0
-            for x in self.closed_overs:
-                if x is local:
-                    break
-                idx += 1
-            if isinstance(local.local, Closure):
-                self.closed_overs.append(local.ctx.get_local(s_name))
-            else:
-                self.closed_overs.append(local.local)
-
+        """Resolves a local, a local of an enclosing fn is closed over the first time it's used"""
+        if self.scope is not None:
+            local = self.scope.lookup(s_name)
+            if local is not None:
+                return local
+
+        idx = self._closure_index.get(s_name, -1)
+        if idx >= 0:
             return ClosureCell(idx)
-        return local
+
+        if self.parent_ctx is None:
+            return None
+        local = self.parent_ctx.get_local(s_name)
+        if local is None:
+            return None
+
+        idx = len(self.closed_overs)
+        self.closed_overs.append(local)
+        self._closure_index[s_name] = idx
+        return ClosureCell(idx)
 
 
     def undef_local(self):
-        self.locals.pop()
+        self.scope = self.scope.parent
 
     def add_const(self, v):
-        for x in range(len(self.consts)):
-            if self.consts[x] is v:
-                return r_uint(x)
-
-        idx = len(self.consts)
-        self.consts.append(v)
+        if INTERN_CONSTANTS:
+            v = _interner.intern(v)
+
+        idx = self._const_index.get(v, -1)
+        if idx < 0:
+            idx = len(self.consts)
+            self.consts.append(v)
+            self._const_index[v] = idx
         return r_uint(idx)
 
     def push_const(self, v):
@@ -133,6 +203,27 @@ class Context(object):
         self.bytecode.append(self.add_const(v))
         self.add_sp(1)
 
+    def push_var_value(self, var):
+        if USE_SUPERINSTRUCTIONS:
+            self.bytecode.append(code.LOAD_VAR_VALUE)
+            self.bytecode.append(self.add_const(var))
+            self.add_sp(1)
+        else:
+            self.push_const(var)
+            self.bytecode.append(code.DEREF_VAR)
+
+    def can_link(self, var):
+        return (DIRECT_LINK or NS_VAR.deref()._direct_link) and var.is_linkable()
+
+    def push_linked_var(self, var):
+        """Pushes the root of var as a const of its own, Code.link_var keeps it current"""
+        idx = len(self.consts)
+        self.consts.append(var.deref())
+        self.links[idx] = var
+        self.bytecode.append(code.LOAD_CONST)
+        self.bytecode.append(r_uint(idx))
+        self.add_sp(1)
+
     def label(self):
         lbl = len(self.bytecode)
         self.bytecode.append(r_uint(99))
@@ -147,6 +238,14 @@ class Context(object):
     def disable_tail_call(self):
         self.can_tail_call = False
 
+    def in_tail_position(self):
+        """True if a call emitted now may replace the current frame. can_tail_call alone
+           only says a recur is legal; a loop that isn't itself in tail position still
+           allows recur in its body."""
+        if not self.can_tail_call or len(self.recur_points) == 0:
+            return False
+        return self.get_recur_point().allows_tail_call()
+
     def pop(self):
         self.bytecode.append(code.POP)
         self.sub_sp(1)
@@ -160,15 +259,22 @@ class FunctionRecurPoint(RecurPoint):
     def __init__(self):
         pass
 
+    def allows_tail_call(self):
+        return True
+
     def emit(self, ctx, argc):
         ctx.bytecode.append(code.RECUR)
         ctx.bytecode.append(argc)
 
 class LoopRecurPoint(RecurPoint):
-    def __init__(self, argc, ctx):
+    def __init__(self, argc, ctx, in_tail_position):
         self._argc = argc
         self._ip = len(ctx.bytecode)
         self._old_sp = ctx.sp() - argc
+        self._in_tail_position = in_tail_position
+
+    def allows_tail_call(self):
+        return self._in_tail_position
 
     def emit(self, ctx, argc):
         affirm(self._argc == argc, u"Recur must have same number of forms as matching loop")
@@ -205,11 +311,6 @@ class Self(LocalType):
         ctx.bytecode.append(code.PUSH_SELF)
         ctx.add_sp(1)
 
-class Closure(LocalType):
-    def __init__(self, local, ctx):
-        self.local = local
-        self.ctx = ctx
-
 class ClosureCell(LocalType):
     def __init__(self, idx):
         self.idx = r_uint(idx)
@@ -228,29 +329,132 @@ def resolve_var(ctx, name):
 def resolve_local(ctx, name):
     return ctx.get_local(name)
 
+def resolve_or_intern_var(ctx, sym):
+    var = resolve_var(ctx, sym)
+    if var is None:
+        var = NS_VAR.deref().intern_or_make(sym._str)
+    return var
+
 
 def is_macro_call(form, ctx):
+    """Returns the var of the macro form calls, or None. ctx may be None when there are
+       no locals that could shadow the macro."""
     if rt.seq_QMARK_(form) is true and isinstance(rt.first(form), symbol.Symbol):
         name = rt.first(form)._str
-        if resolve_local(ctx, name):
+        if ctx is not None and resolve_local(ctx, name):
             return None
         var = resolve_var(ctx, rt.first(form))
 
-        if var and var.is_defined():
+        if isinstance(var, code.Var) and var.is_defined():
             val = var.deref()
             if isinstance(val, code.BaseCode) and val.is_macro():
-                return val
+                return var
     return None
 
 def call_macro(var, form, ctx):
-    form = rt.next(form)
-    args = [None] * rt.count(form).int_val()
+    expansion = _macro_cache.get(form, var)
+    if expansion is not None:
+        return expansion
+
+    args_form = rt.next(form)
+    args = [None] * seq_count(args_form)
     i = 0
-    while form is not nil:
-        args[i] = rt.first(form)
-        form = rt.next(form)
+    while args_form is not nil:
+        args[i] = rt.first(args_form)
+        args_form = rt.next(args_form)
         i += 1
-    return var.invoke(args)
+    expansion = var.invoke(args)
+    _macro_cache.put(form, var, expansion)
+    return expansion
+
+
+MACRO_CACHE_SIZE = 1024
+
+class MacroCacheEntry(object):
+    def __init__(self, form, var, rev, expansion):
+        self.form = form
+        self.var = var
+        self.rev = rev
+        self.expansion = expansion
+        self.prev = None
+        self.next = None
+
+class MacroCache(object):
+    """LRU cache of macro expansions keyed by form identity. An entry is only used while the
+       macro var's _rev is unchanged, so redefining the macro invalidates it."""
+    def __init__(self, size):
+        self._size = size
+        self._entries = {}
+        self._newest = None
+        self._oldest = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, form, var):
+        entry = self._entries.get(form, None)
+        if entry is None or entry.var is not var or entry.rev != var._rev:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._link_newest(entry)
+        return entry.expansion
+
+    def put(self, form, var, expansion):
+        entry = self._entries.get(form, None)
+        if entry is not None:
+            self._unlink(entry)
+        elif len(self._entries) >= self._size:
+            oldest = self._oldest
+            self._unlink(oldest)
+            del self._entries[oldest.form]
+        entry = MacroCacheEntry(form, var, var._rev, expansion)
+        self._entries[form] = entry
+        self._link_newest(entry)
+
+    def _unlink(self, entry):
+        if entry.prev is not None:
+            entry.prev.next = entry.next
+        else:
+            self._oldest = entry.next
+        if entry.next is not None:
+            entry.next.prev = entry.prev
+        else:
+            self._newest = entry.prev
+        entry.prev = None
+        entry.next = None
+
+    def _link_newest(self, entry):
+        entry.prev = self._newest
+        if self._newest is not None:
+            self._newest.next = entry
+        else:
+            self._oldest = entry
+        self._newest = entry
+
+_macro_cache = MacroCache(MACRO_CACHE_SIZE)
+
+@as_var("macroexpand-1")
+def macroexpand_1(form):
+    var = is_macro_call(form, None)
+    if var is None:
+        return form
+    return call_macro(var, form, None)
+
+@as_var("macroexpand")
+def macroexpand(form):
+    while True:
+        var = is_macro_call(form, None)
+        if var is None:
+            return form
+        form = call_macro(var, form, None)
+
+@as_var("set-direct-linking!")
+def set_direct_linking(flag):
+    """Calls to non-dynamic vars compiled in the current namespace from now on embed the
+       var's root, and are relinked when the var is redefined"""
+    NS_VAR.deref()._direct_link = flag is not nil and flag is not false
+    return nil
 
 class CompileMapRf(code.NativeFn):
     def __init__(self, ctx):
@@ -262,13 +466,17 @@ class CompileMapRf(code.NativeFn):
         return nil
 
 def compile_map_literal(form, ctx):
+    ctc = ctx.can_tail_call
+    ctx.disable_tail_call()
     ctx.push_const(code.intern_var(u"pixie.stdlib", u"hashmap"))
 
     rt.reduce(CompileMapRf(ctx), nil, form)
 
     size = rt.count(form).int_val() * 2
-    ctx.bytecode.append(code.INVOKE)
-    ctx.bytecode.append(r_uint(size) + 1)
+    ctx.emit_invoke(size + 1)
+    ctx.sub_sp(size)
+    if ctc:
+        ctx.enable_tail_call()
 
 
 
@@ -287,14 +495,7 @@ def compile_form(form, ctx):
         name = form._str
         loc = resolve_local(ctx, name)
         if loc is None:
-            var = resolve_var(ctx, form)
-
-            if var is None:
-                var = NS_VAR.deref().intern_or_make(name)
-
-            ctx.push_const(var)
-
-            ctx.bytecode.append(code.DEREF_VAR)
+            ctx.push_var_value(resolve_or_intern_var(ctx, form))
             return
         loc.emit(ctx)
         return
@@ -311,13 +512,16 @@ def compile_form(form, ctx):
         vector_var = rt.vector()
         size = rt.count(form).int_val()
         #assert rt.count(form).int_val() == 0
+        ctc = ctx.can_tail_call
+        ctx.disable_tail_call()
         ctx.push_const(code.intern_var(u"pixie.stdlib", u"vector"))
         for x in range(size):
             compile_form(rt.nth(form, rt.wrap(x)), ctx)
 
-        ctx.bytecode.append(code.INVOKE)
-        ctx.bytecode.append(r_uint(size + 1))
+        ctx.emit_invoke(size + 1)
         ctx.sub_sp(size)
+        if ctc:
+            ctx.enable_tail_call()
         return
 
     if rt.instance_QMARK_(rt.IMap.deref(), form):
@@ -330,31 +534,51 @@ def compile_form(form, ctx):
 
     raise Exception("Can't compile ")
 
-def compile_platform_plus(form, ctx):
+# Two argument calls to these pixie.stdlib vars compile to an opcode instead of an invoke
+BINARY_OPS = {u"+": code.ADD,
+              u"-": code.SUB,
+              u"*": code.MUL,
+              u"<": code.LT,
+              u">": code.GT,
+              u"=": code.EQ,
+              u"-add": code.ADD,
+              u"-sub": code.SUB,
+              u"-mul": code.MUL,
+              u"-lt": code.LT,
+              u"-gt": code.GT,
+              u"-num-eq": code.NUM_EQ}
+
+def is_binary_op(var, argc):
+    """True if calling var with argc args compiles to one of BINARY_OPS. Dynamic vars are
+       always invoked, so they can still be rebound."""
+    return argc == 2 and var._ns == u"pixie.stdlib" and not var._dynamic and var._name in BINARY_OPS
+
+def seq_count(form):
+    cnt = 0
+    while form is not nil:
+        cnt += 1
+        form = rt.next(form)
+    return cnt
+
+def compile_binary_op(op, args, ctx):
     ctc = ctx.can_tail_call
     ctx.disable_tail_call()
-    form = form.next()
-    while form is not nil:
-        compile_form(form.first(), ctx)
-        form = form.next()
+    affirm(seq_count(args) == 2, u"Expected two arguments")
+    while args is not nil:
+        compile_form(rt.first(args), ctx)
+        args = rt.next(args)
 
-    ctx.bytecode.append(code.ADD)
+    ctx.bytecode.append(op)
     ctx.sub_sp(1)
     if ctc:
         ctx.enable_tail_call()
     return ctx
 
-def compile_platform_eq(form, ctx):
-    form = form.next()
-
-    affirm(rt.count(form).int_val() == 2, u"TODO: REMOVE")
-    while form is not nil:
-        compile_form(form.first(), ctx)
-        form = form.next()
+def compile_platform_plus(form, ctx):
+    return compile_binary_op(code.ADD, form.next(), ctx)
 
-    ctx.bytecode.append(code.EQ)
-    ctx.sub_sp(1)
-    return ctx
+def compile_platform_eq(form, ctx):
+    return compile_binary_op(code.EQ, form.next(), ctx)
 
 def add_args(args, ctx):
     required_args = -1
@@ -383,27 +607,66 @@ def compile_fn(form, ctx):
 
 
     if rt.instance_QMARK_(rt.ISeq.deref(), rt.first(form)):
-        arities = []
+        bodies = []
         while form is not nil:
-            required_arity, argc = compile_fn_body(name, rt.first(rt.first(form)), rt.next(rt.first(form)), ctx)
-            arities.append(argc if required_arity == -1 else required_arity | 256)
+            bodies.append(compile_fn_code(name, rt.first(rt.first(form)), rt.next(rt.first(form)), ctx))
             form = rt.next(form)
+        compile_multi_arity(bodies, ctx)
 
-        ctx.bytecode.append(code.MAKE_MULTI_ARITY)
-        ctx.bytecode.append(r_uint(len(arities)))
-        arities.reverse()
-        for x in arities:
-            ctx.bytecode.append(r_uint(x))
+    else:
+        emit_fn(compile_fn_code(name, rt.first(form), rt.next(form), ctx), ctx)
+
+
+def compile_multi_arity(bodies, ctx):
+    """Builds the MultiArityFn now if none of the bodies close over anything, otherwise emits
+       MAKE_MULTI_ARITY to build it from the fns on the stack"""
+    constant = True
+    for body in bodies:
+        if len(body.closed_overs) > 0:
+            constant = False
+
+    if constant:
+        size = 0
+        for body in bodies:
+            if body.required_args < 0 and body.argc + 1 > size:
+                size = body.argc + 1
+        arities = [None] * size
+        required_arity = 0
+        rest_fn = None
+        for body in bodies:
+            if body.required_args >= 0:
+                affirm(rest_fn is None, u"Can't have multiple rest_fns")
+                required_arity = body.required_args
+                rest_fn = code.VariadicCode(body.code_obj, r_uint(body.required_args))
+            else:
+                arities[body.argc] = body.code_obj
+        ctx.push_const(code.MultiArityFn(arities, required_arity, rest_fn))
+        return
 
-        ctx.sub_sp(len(arities))
+    arities = []
+    for body in bodies:
+        emit_fn(body, ctx)
+        arities.append(body.argc if body.required_args == -1 else body.required_args | 256)
 
-    else:
-        compile_fn_body(name, rt.first(form), rt.next(form), ctx)
+    ctx.bytecode.append(code.MAKE_MULTI_ARITY)
+    ctx.bytecode.append(r_uint(len(arities)))
+    arities.reverse()
+    for x in arities:
+        ctx.bytecode.append(r_uint(x))
+
+    ctx.sub_sp(len(arities))
 
 
+class FnBody(object):
+    """A compiled fn body, and the locals of the enclosing context it closes over"""
+    def __init__(self, code_obj, closed_overs, required_args, argc):
+        self.code_obj = code_obj
+        self.closed_overs = closed_overs
+        self.required_args = required_args
+        self.argc = argc
 
 
-def compile_fn_body(name, args, body, ctx):
+def compile_fn_code(name, args, body, ctx):
     new_ctx = Context(name._str, rt.count(args).int_val(), ctx)
     required_args = add_args(args, new_ctx)
     bc = 0
@@ -428,22 +691,22 @@ def compile_fn_body(name, args, body, ctx):
             body = rt.next(body)
 
     new_ctx.bytecode.append(code.RETURN)
-    closed_overs = new_ctx.closed_overs
-    if len(closed_overs) == 0:
-        ctx.push_const(new_ctx.to_code(required_args))
-    else:
-        ctx.push_const(new_ctx.to_code(required_args))
-        for x in closed_overs:
+    return FnBody(new_ctx.to_code(required_args), new_ctx.closed_overs, required_args,
+                  rt.count(args).int_val())
+
+def emit_fn(body, ctx):
+    """Pushes the fn for a compiled body, closing over the enclosing locals it uses"""
+    ctx.push_const(body.code_obj)
+    if len(body.closed_overs) > 0:
+        for x in body.closed_overs:
             x.emit(ctx)
         ctx.bytecode.append(code.MAKE_CLOSURE)
-        ctx.bytecode.append(r_uint(len(closed_overs)))
-        ctx.sub_sp(len(closed_overs))
+        ctx.bytecode.append(r_uint(len(body.closed_overs)))
+        ctx.sub_sp(len(body.closed_overs))
 
-    if required_args >= 0:
+    if body.required_args >= 0:
         ctx.bytecode.append(code.MAKE_VARIADIC)
-        ctx.bytecode.append(r_uint(required_args))
-
-    return required_args, rt.count(args).int_val()
+        ctx.bytecode.append(r_uint(body.required_args))
 
 def compile_if(form, ctx):
     form = form.next()
@@ -455,14 +718,27 @@ def compile_if(form, ctx):
     form = rt.next(form)
     els = rt.first(form)
 
+    ctc = ctx.can_tail_call
     ctx.disable_tail_call()
-    compile_form(test, ctx)
-    ctx.bytecode.append(code.COND_BR)
-    ctx.sub_sp(1)
+    loc = None
+    if USE_SUPERINSTRUCTIONS and isinstance(test, symbol.Symbol):
+        loc = resolve_local(ctx, test._str)
+
+    if isinstance(loc, Arg):
+        ctx.bytecode.append(code.ARG_COND_BR)
+        ctx.bytecode.append(loc.idx)
+    elif isinstance(loc, LetBinding):
+        ctx.bytecode.append(code.DUP_NTH_COND_BR)
+        ctx.bytecode.append(r_uint(ctx.sp() - loc.sp))
+    else:
+        compile_form(test, ctx)
+        ctx.bytecode.append(code.COND_BR)
+        ctx.sub_sp(1)
     sp1 = ctx.sp()
     cond_lbl = ctx.label()
 
-    ctx.enable_tail_call()
+    if ctc:
+        ctx.enable_tail_call()
 
     compile_form(then, ctx)
     ctx.bytecode.append(code.JMP)
@@ -485,15 +761,24 @@ def compile_def(form, ctx):
     affirm(isinstance(name, symbol.Symbol), u"Def'd name must be a symbol")
 
     var = NS_VAR.deref().intern_or_make(rt.name(name))
+    ctc = ctx.can_tail_call
+    ctx.disable_tail_call()
     ctx.push_const(var)
     compile_form(val, ctx)
     ctx.bytecode.append(code.SET_VAR)
     ctx.sub_sp(1)
+    if ctc:
+        ctx.enable_tail_call()
 
 def compile_do(form, ctx):
     form = rt.next(form)
+    ctc = ctx.can_tail_call
 
     while True:
+        if ctc and rt.next(form) is nil:
+            ctx.enable_tail_call()
+        else:
+            ctx.disable_tail_call()
         compile_form(rt.first(form), ctx)
         form = rt.next(form)
 
@@ -534,6 +819,7 @@ def compile_let(form, ctx):
     ctc = ctx.can_tail_call
     ctx.disable_tail_call()
 
+    scope = ctx.scope
     binding_count = 0
     for i in range(0, rt.count(bindings).int_val(), 2):
         binding_count += 1
@@ -545,10 +831,9 @@ def compile_let(form, ctx):
 
         ctx.add_local(name._str, LetBinding(ctx.sp()))
 
-    if ctc:
-        ctx.enable_tail_call()
-
     while True:
+        if ctc and rt.next(body) is nil:
+            ctx.enable_tail_call()
         compile_form(rt.first(body), ctx)
         body = rt.next(body)
 
@@ -557,10 +842,68 @@ def compile_let(form, ctx):
         else:
             ctx.pop()
 
+    ctx.scope = scope
     ctx.bytecode.append(code.POP_UP_N)
     ctx.sub_sp(binding_count)
     ctx.bytecode.append(binding_count)
 
+def compile_binding(form, ctx):
+    """(binding [name val ...] body ...) binds the dynamic vars to the vals while body runs.
+       The vars are resolved when compiling, the names may be quoted as with-bindings took
+       them. The body is never in tail position, so the frame is still there to pop the
+       bindings, even if the body throws."""
+    form = next(form)
+    bindings = rt.first(form)
+    affirm(isinstance(bindings, PersistentVector), u"Bindings must be a vector")
+    body = next(form)
+
+    ctc = ctx.can_tail_call
+    ctx.disable_tail_call()
+
+    vars = []
+    for i in range(0, rt.count(bindings).int_val(), 2):
+        name = rt.nth(bindings, rt.wrap(i))
+        if is_quoted(name):
+            name = rt.first(rt.next(name))
+        affirm(isinstance(name, symbol.Symbol), u"Binding names must be symbols")
+        vars.append(resolve_or_intern_var(ctx, name))
+        compile_form(rt.nth(bindings, rt.wrap(i + 1)), ctx)
+
+    ctx.bytecode.append(code.PUSH_BINDINGS)
+    ctx.bytecode.append(r_uint(len(vars)))
+    for var in vars:
+        ctx.bytecode.append(ctx.add_const(var))
+    ctx.sub_sp(len(vars))
+
+    if body is nil:
+        ctx.push_const(nil)
+    while body is not nil:
+        compile_form(rt.first(body), ctx)
+        body = rt.next(body)
+        if body is not nil:
+            ctx.pop()
+
+    ctx.bytecode.append(code.POP_BINDINGS)
+    if ctc:
+        ctx.enable_tail_call()
+
+def compile_with_bindings(form, ctx):
+    """(with-bindings binds body ...) compiles like binding when binds is a literal vector.
+       Otherwise binds is only known at runtime, so the body becomes a thunk for
+       with-bindings*, which resolves the names and pushes the frame itself."""
+    bindings = rt.first(next(form))
+    if isinstance(bindings, PersistentVector):
+        return compile_binding(form, ctx)
+    thunk = cons(symbol.symbol(u"fn"), cons(EMPTY, next(next(form))))
+    call = cons(symbol.symbol(u"pixie.stdlib/with-bindings*"), cons(bindings, cons(thunk)))
+    return compile_form(call, ctx)
+
+def is_quoted(form):
+    if form is nil or not rt.instance_QMARK_(rt.ISeq.deref(), form):
+        return False
+    head = rt.first(form)
+    return isinstance(head, symbol.Symbol) and head._str == u"quote"
+
 def compile_loop(form, ctx):
     form = next(form)
     bindings = rt.first(form)
@@ -568,8 +911,10 @@ def compile_loop(form, ctx):
     body = next(form)
 
     ctc = ctx.can_tail_call
+    in_tail_position = ctx.in_tail_position()
     ctx.disable_tail_call()
 
+    scope = ctx.scope
     binding_count = 0
     for i in range(0, rt.count(bindings).int_val(), 2):
         binding_count += 1
@@ -581,11 +926,11 @@ def compile_loop(form, ctx):
 
         ctx.add_local(name._str, LetBinding(ctx.sp()))
 
-    if ctc:
-        ctx.enable_tail_call()
-
-    ctx.push_recur_point(LoopRecurPoint(binding_count, ctx))
+    ctx.push_recur_point(LoopRecurPoint(binding_count, ctx, in_tail_position))
     while True:
+        # the last form is always a recur position, even if the loop itself isn't in tail position
+        if next(body) is nil:
+            ctx.enable_tail_call()
         compile_form(rt.first(body), ctx)
         body = next(body)
 
@@ -595,6 +940,9 @@ def compile_loop(form, ctx):
             ctx.pop()
 
     ctx.pop_recur_point()
+    if not ctc:
+        ctx.disable_tail_call()
+    ctx.scope = scope
     ctx.bytecode.append(code.POP_UP_N)
     ctx.sub_sp(binding_count)
     ctx.bytecode.append(binding_count)
@@ -619,12 +967,15 @@ def compile_ns(form, ctx):
 builtins = {u"fn": compile_fn,
             u"if": compile_if,
             u"platform=": compile_platform_eq,
+            u"platform+": compile_platform_plus,
             u"def": compile_def,
             u"do": compile_do,
             u"quote": compile_quote,
             u"recur": compile_recur,
             u"let": compile_let,
             u"loop": compile_loop,
+            u"binding": compile_binding,
+            u"with-bindings": compile_with_bindings,
             u"comment": compile_comment,
             u"ns": compile_ns}
 
@@ -639,28 +990,73 @@ def compile_cons(form, ctx):
 
     meta = rt.meta(form)
 
+    # the var a non-local symbol in head position calls, None for any other head
+    head = rt.first(form)
+    var = None
+    if isinstance(head, symbol.Symbol) and resolve_local(ctx, head._str) is None:
+        var = resolve_or_intern_var(ctx, head)
+
+    if var is not None and is_binary_op(var, seq_count(rt.next(form))):
+        return compile_binary_op(BINARY_OPS[var._name], rt.next(form), ctx)
+
+    linked = None
+    if var is not None and ctx.can_link(var):
+        linked = var
+
+    tail_call = ctx.in_tail_position()
+    if USE_SUPERINSTRUCTIONS and not tail_call and var is not None and linked is None:
+        return compile_var_invoke(var, rt.next(form), meta, ctx)
+
     cnt = 0
     ctc = ctx.can_tail_call
     while form is not nil:
         ctx.disable_tail_call()
-        compile_form(rt.first(form), ctx)
+        if cnt == 0 and linked is not None:
+            ctx.push_linked_var(linked)
+        else:
+            compile_form(rt.first(form), ctx)
         cnt += 1
         form = rt.next(form)
 
     if ctc:
         ctx.enable_tail_call()
 
-    #if ctx.can_tail_call:
-    #    ctx.bytecode.append(code.TAIL_CALL)
-    #else:
     if meta is not nil:
         ctx.debug_points[len(ctx.bytecode)] = meta
-    ctx.bytecode.append(code.INVOKE)
-
-    ctx.bytecode.append(cnt)
+    if tail_call:
+        ctx.bytecode.append(code.TAIL_CALL)
+        ctx.bytecode.append(r_uint(cnt))
+        ctx.bytecode.append(ctx.add_inline_cache())
+    else:
+        ctx.emit_invoke(cnt)
     ctx.sub_sp(cnt - 1)
 
 
+def compile_var_invoke(var, args, meta, ctx):
+    """Calls the value of a var without pushing the var itself, emits INVOKE_VAR"""
+    argc = 0
+    ctc = ctx.can_tail_call
+    while args is not nil:
+        ctx.disable_tail_call()
+        compile_form(rt.first(args), ctx)
+        argc += 1
+        args = rt.next(args)
+
+    if ctc:
+        ctx.enable_tail_call()
+
+    if meta is not nil:
+        ctx.debug_points[len(ctx.bytecode)] = meta
+    ctx.bytecode.append(code.INVOKE_VAR)
+    ctx.bytecode.append(ctx.add_const(var))
+    ctx.bytecode.append(r_uint(argc))
+    ctx.bytecode.append(ctx.add_inline_cache())
+    if argc == 0:
+        ctx.add_sp(1)
+    else:
+        ctx.sub_sp(argc - 1)
+
+
 def compile(form):
     ctx = Context(u"main", 0, None)
     compile_form(form, ctx)
@@ -1,15 +1,30 @@
-from pixie.vm.object import Object, affirm, WrappedException
+from pixie.vm.object import Object, affirm, WrappedException, PolymorphicCodeInfo
 import pixie.vm.code as code
 import pixie.vm.numbers as numbers
 from pixie.vm.primitives import nil, true, false
 from rpython.rlib.rarithmetic import r_uint, intmask
-from rpython.rlib.jit import JitDriver, promote, elidable, elidable_promote, hint, unroll_safe
+from rpython.rlib.jit import JitDriver, promote, promote_string, elidable, elidable_promote, hint, \
+    unroll_safe
 import rpython.rlib.jit as jit
 import rpython.rlib.debug as debug
 import pixie.vm.rt as rt
 
 def get_location(ip, sp, bc, base_code):
-    return code.BYTECODES[bc[ip]] + " in " + str(base_code._name)
+    return code.BYTECODES[code.bytecode_at(bc, ip)] + " in " + str(base_code._name)
+
+# Untranslated only: set to True to have interpret() count calls and opcode dispatches
+# (see benchmarks/dispatch_counts.py). Translation constant-folds this away.
+COUNT_DISPATCHES = False
+
+class DispatchStats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.dispatches = 0
+
+dispatch_stats = DispatchStats()
 
 jitdriver = JitDriver(greens=["ip", "sp", "bc", "base_code"], reds=["frame"], virtualizables=["frame"],
                       get_printable_location=get_location)
@@ -17,7 +32,7 @@ jitdriver = JitDriver(greens=["ip", "sp", "bc", "base_code"], reds=["frame"], vi
 
 @elidable
 def get_inst_by_idx(bc, idx):
-    return bc[idx]
+    return code.bytecode_at(bc, idx)
 
 class Frame(object):
     _virtualizable_ = ["stack[*]",
@@ -50,8 +65,8 @@ class Frame(object):
             self.closed_overs = []
 
     def get_inst(self):
-        assert 0 <= self.ip < len(self.bc)
-        inst = get_inst_by_idx(promote(self.bc), promote(self.ip))
+        assert 0 <= self.ip < code.bytecode_len(self.bc)
+        inst = get_inst_by_idx(promote_string(self.bc), promote(self.ip))
         self.ip = self.ip + 1
         return promote(inst)
 
@@ -79,9 +94,12 @@ class Frame(object):
     def push_nth(self, delta):
         self.push(self.nth(delta))
 
-    def push_arg(self, idx):
+    def get_arg(self, idx):
         assert 0 <= idx < len(self.args)
-        self.push(self.args[r_uint(idx)])
+        return self.args[r_uint(idx)]
+
+    def push_arg(self, idx):
+        self.push(self.get_arg(idx))
 
     @unroll_safe
     def push_n(self, args, argc):
@@ -90,6 +108,35 @@ class Frame(object):
             self.push(args[x])
             x += 1
 
+    @unroll_safe
+    def push_bindings(self, argc):
+        """Pushes a binding frame and binds the vars in the next argc consts to the top argc
+           stack values"""
+        code._dynamic_vars.push_binding_frame()
+        vals = self.pop_n(argc)
+        x = r_uint(0)
+        while x < argc:
+            var = self.get_const(self.get_inst())
+            assert isinstance(var, code.Var)
+            var.set_value(vals[x])
+            x += 1
+
+    @unroll_safe
+    def recur(self, argc):
+        """Rebinds the args in place from the top argc stack values and restarts the code,
+           clearing the rest of the stack. Returns False if argc doesn't match the args
+           this frame was invoked with."""
+        if len(self.args) != argc:
+            return False
+        x = r_uint(0)
+        while x < argc:
+            self.args[argc - x - 1] = self.pop()
+            x += 1
+        while self.sp > 0:
+            self.pop()
+        self.ip = r_uint(0)
+        return True
+
     @unroll_safe
     def pop_n(self, argc):
         args = [None] * argc
@@ -115,23 +162,101 @@ class Frame(object):
 
 @jit.unroll_safe
 def make_multi_arity(frame, argc):
-    d = {}
+    ops = [frame.get_inst() for i in range(argc)]
+    size = 0
+    for a in ops:
+        if not a & 256 and intmask(a) + 1 > size:
+            size = intmask(a) + 1
+
+    arities = [None] * size
     required_arity = 0
     rest_fn = None
-    for i in range(argc):
-        a = frame.get_inst()
+    for a in ops:
         if a & 256:
             affirm(rest_fn is None, u"Can't have multiple rest_fns")
-            required_arity = a & 0xFF
+            required_arity = intmask(a & 0xFF)
             rest_fn = frame.pop()
         else:
-            fn = frame.pop()
-            d[a] = fn
-
-    return code.MultiArityFn(d, required_arity, rest_fn)
+            arities[a] = frame.pop()
+
+    return code.MultiArityFn(arities, required_arity, rest_fn)
+
+def invoke_from_stack(frame, fn, argc, cache):
+    """Calls fn with the top argc values of the frame's stack. Protocol dispatch goes through
+       the call site's inline cache, except in JIT traces where the lookups are already
+       constant folded."""
+    if argc >= 1 and not jit.we_are_jitted():
+        a = frame.nth(argc - 1)
+        target = cache.lookup(fn, a, frame.nth(argc - 2) if argc >= 2 else None)
+        if target is not fn and isinstance(fn, code.PolymorphicFn):
+            try:
+                return pop_and_invoke(frame, target, argc)
+            except WrappedException as ex:
+                ex._ex._trace.append(PolymorphicCodeInfo(fn._name, a.type()))
+                raise
+        return pop_and_invoke(frame, target, argc)
+    return pop_and_invoke(frame, fn, argc)
+
+def pop_and_invoke(frame, fn, argc):
+    """Pops argc args off the frame and calls fn with them, using the fixed-arity entry
+       points when possible so no args list is allocated."""
+    if argc == 0:
+        return fn.invoke0()
+    if argc == 1:
+        a = frame.pop()
+        return fn.invoke1(a)
+    if argc == 2:
+        b = frame.pop()
+        a = frame.pop()
+        return fn.invoke2(a, b)
+    if argc == 3:
+        c = frame.pop()
+        b = frame.pop()
+        a = frame.pop()
+        return fn.invoke3(a, b, c)
+    return fn.invoke(frame.pop_n(argc))
+
+def is_interpreted(fn):
+    return isinstance(fn, code.Code) or isinstance(fn, code.Closure)
+
+def resolve_tail_call(fn, args, cache):
+    """Unwraps vars, arity dispatch, variadic packing and protocol dispatch until fn is either
+       interpreted code, whose frame can replace the caller's, or native code."""
+    while True:
+        if isinstance(fn, code.Var):
+            fn = fn.deref()
+        elif isinstance(fn, code.MultiArityFn):
+            fn = fn.get_fn(len(args))
+        elif isinstance(fn, code.VariadicCode):
+            args = fn.pack_args(args)
+            fn = fn._code
+        elif isinstance(fn, code.PolymorphicFn) and len(args) >= 1:
+            if jit.we_are_jitted():
+                fn = fn.get_protocol_fn(args[0].type(), fn._rev)
+            else:
+                fn = cache.lookup(fn, args[0], None)
+        elif isinstance(fn, code.DoublePolymorphicFn) and len(args) >= 2:
+            if jit.we_are_jitted():
+                fn = fn.get_fn(args[0].type(), args[1].type(), fn._rev)
+            else:
+                fn = cache.lookup(fn, args[0], args[1])
+        else:
+            affirm(isinstance(fn, code.BaseCode), u"Can't call a non-function")
+            return fn, args
 
 def interpret(code_obj, args=[]):
-    frame = Frame(code_obj, args)
+    """Runs code_obj with args. An exception leaving it also pops any binding frames pushed
+       since it was entered, so PUSH_BINDINGS needs no handler in the dispatch loop."""
+    top = code._dynamic_vars.top()
+    try:
+        return run_frame(Frame(code_obj, args))
+    except WrappedException:
+        code._dynamic_vars.unwind_to(top)
+        raise
+
+def run_frame(frame):
+    if COUNT_DISPATCHES:
+        dispatch_stats.calls += 1
     while True:
         jitdriver.jit_merge_point(bc=frame.bc,
                                   ip=frame.ip,
@@ -139,6 +264,8 @@ def interpret(code_obj, args=[]):
                                   base_code=frame.base_code,
                                   frame=frame)
         inst = frame.get_inst()
+        if COUNT_DISPATCHES:
+            dispatch_stats.dispatches += 1
 
         #print code.BYTECODES[inst]
 
@@ -147,38 +274,79 @@ def interpret(code_obj, args=[]):
             frame.push_const(arg)
             continue
 
+        if inst == code.LOAD_VAR_VALUE:
+            var = frame.get_const(frame.get_inst())
+            if not isinstance(var, code.Var):
+                affirm(False, u"Can't deref " + var.type()._name)
+            frame.push(var.deref())
+            continue
+
+        if inst == code.INVOKE_VAR:
+            debug_ip = frame.ip
+            var = frame.get_const(frame.get_inst())
+            argc = frame.get_inst()
+            cache = frame.code_obj.get_inline_cache(frame.get_inst())
+            assert isinstance(var, code.Var)
+
+            try:
+                frame.push(invoke_from_stack(frame, var.deref(), argc, cache))
+                continue
+            except WrappedException as ex:
+                dp = frame.code_obj.get_debug_point(debug_ip - 1)
+                if dp:
+                    ex._ex._trace.append(dp)
+                raise
+
         if inst == code.INVOKE:
             debug_ip = frame.ip
             argc = frame.get_inst()
+            cache = frame.code_obj.get_inline_cache(frame.get_inst())
             fn = frame.nth(argc - 1)
 
             assert isinstance(fn, code.BaseCode), "Expected callable, got " + str(fn)
 
+            try:
+                result = invoke_from_stack(frame, fn, argc - 1, cache)
+                frame.pop()
+                frame.push(result)
+                continue
+            except WrappedException as ex:
+                dp = frame.code_obj.get_debug_point(debug_ip - 1)
+                if dp:
+                    ex._ex._trace.append(dp)
+                raise
 
+            continue
+
+        if inst == code.TAIL_CALL:
+            debug_ip = frame.ip
+            argc = frame.get_inst()
+            cache = frame.code_obj.get_inline_cache(frame.get_inst())
+            fn = frame.nth(argc - 1)
+
+            assert isinstance(fn, code.BaseCode), "Expected callable, got " + str(fn)
 
             args = frame.pop_n(argc - 1)
             frame.pop()
+
             try:
-                frame.push(fn.invoke(args))
-                continue
+                fn, args = resolve_tail_call(fn, args, cache)
+                if not is_interpreted(fn):
+                    return fn.invoke(args)
             except WrappedException as ex:
-                dp = code_obj.get_debug_point(debug_ip - 1)
+                dp = frame.code_obj.get_debug_point(debug_ip - 1)
                 if dp:
                     ex._ex._trace.append(dp)
                 raise
 
-            continue
+            frame = Frame(fn, args)
 
-        # if inst == code.TAIL_CALL:
-        #     argc = frame.get_inst()
-        #     fn = frame.nth(argc - 1)
-        #
-        #     assert isinstance(fn, code.BaseCode)
-        #
-        #     args = frame.pop_n(argc - 1)
-        #     frame.pop()
-        #
-        #     return code.TailCall(fn, args)
+            jitdriver.can_enter_jit(bc=frame.bc,
+                                  ip=frame.ip,
+                                  sp=frame.sp,
+                                  base_code=frame.base_code,
+                                  frame=frame)
+            continue
 
         if inst == code.ARG:
             arg = frame.get_inst()
@@ -199,17 +367,69 @@ def interpret(code_obj, args=[]):
             frame.jump_rel(loc)
             continue
 
+        if inst == code.ARG_COND_BR:
+            v = frame.get_arg(frame.get_inst())
+            loc = frame.get_inst()
+            if v is not nil and v is not false:
+                continue
+            frame.jump_rel(loc)
+            continue
+
+        if inst == code.DUP_NTH_COND_BR:
+            v = frame.nth(frame.get_inst())
+            loc = frame.get_inst()
+            if v is not nil and v is not false:
+                continue
+            frame.jump_rel(loc)
+            continue
+
         if inst == code.JMP:
             ip = frame.get_inst()
             frame.jump_rel(ip)
             continue
 
         if inst == code.EQ:
-            a = frame.pop()
             b = frame.pop()
+            a = frame.pop()
             frame.push(numbers.eq(a, b))
             continue
 
+        if inst == code.ADD:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.add(a, b))
+            continue
+
+        if inst == code.SUB:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.sub(a, b))
+            continue
+
+        if inst == code.MUL:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.mul(a, b))
+            continue
+
+        if inst == code.LT:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.lt(a, b))
+            continue
+
+        if inst == code.GT:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.gt(a, b))
+            continue
+
+        if inst == code.NUM_EQ:
+            b = frame.pop()
+            a = frame.pop()
+            frame.push(numbers.num_eq(a, b))
+            continue
+
         if inst == code.MAKE_CLOSURE:
             argc = frame.get_inst()
 
@@ -252,9 +472,8 @@ def interpret(code_obj, args=[]):
 
         if inst == code.RECUR:
             argc = frame.get_inst()
-            args = frame.pop_n(argc)
-
-            frame = Frame(frame.code_obj, args)
+            if not frame.recur(argc):
+                frame = Frame(frame.code_obj, frame.pop_n(argc))
 
             jitdriver.can_enter_jit(bc=frame.bc,
                                   ip=frame.ip,
@@ -311,6 +530,14 @@ def interpret(code_obj, args=[]):
             continue
 
 
+        if inst == code.PUSH_BINDINGS:
+            frame.push_bindings(frame.get_inst())
+            continue
+
+        if inst == code.POP_BINDINGS:
+            code._dynamic_vars.pop_binding_frame()
+            continue
+
         print "NO DISPATCH FOR: " + code.BYTECODES[inst]
         raise Exception()
 
@@ -34,6 +34,8 @@ _sub = as_var("-sub")(DoublePolymorphicFn(u"-sub", IMath))
 _mul = as_var("-mul")(DoublePolymorphicFn(u"-mul", IMath))
 _div = as_var("-div")(DoublePolymorphicFn(u"-div", IMath))
 _num_eq = as_var("-num-eq")(DoublePolymorphicFn(u"-num-eq", IMath))
+_lt = as_var("-lt")(DoublePolymorphicFn(u"-lt", IMath))
+_gt = as_var("-gt")(DoublePolymorphicFn(u"-gt", IMath))
 _num_eq.set_default_fn(wrap_fn(lambda a, b: false))
 
 
@@ -55,23 +57,56 @@ def _div(a, b):
     return rt.wrap(a.int_val() / b.int_val())
 
 @extend(_num_eq, Integer._type, Integer._type)
-def _div(a, b):
+def _num_eq(a, b):
     return true if a.int_val() == b.int_val() else false
 
+@extend(_lt, Integer._type, Integer._type)
+def _lt(a, b):
+    return true if a.int_val() < b.int_val() else false
 
-# def add(a, b):
-#     if isinstance(a, Integer):
-#         if isinstance(b, Integer):
-#             return Integer(a.int_val() + b.int_val())
-#
-#     raise Exception("Add error")
+@extend(_gt, Integer._type, Integer._type)
+def _gt(a, b):
+    return true if a.int_val() > b.int_val() else false
 
-def eq(a, b):
-    if isinstance(a, Integer):
-        if isinstance(b, Integer):
-            return true if a.int_val() == b.int_val() else false
 
-    raise Exception("Add error")
+## Used by the interpreter's math opcodes, Integer/Integer is handled inline, everything
+## else goes through IMath
+
+def add(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return Integer(a.int_val() + b.int_val())
+    return _add.invoke2(a, b)
+
+def sub(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return Integer(a.int_val() - b.int_val())
+    return _sub.invoke2(a, b)
+
+def mul(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return Integer(a.int_val() * b.int_val())
+    return _mul.invoke2(a, b)
+
+def lt(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return true if a.int_val() < b.int_val() else false
+    return _lt.invoke2(a, b)
+
+def gt(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return true if a.int_val() > b.int_val() else false
+    return _gt.invoke2(a, b)
+
+def num_eq(a, b):
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return true if a.int_val() == b.int_val() else false
+    return _num_eq.invoke2(a, b)
+
+def eq(a, b):
+    """Generic equality (the = fn), with an inline Integer path"""
+    if isinstance(a, Integer) and isinstance(b, Integer):
+        return true if a.int_val() == b.int_val() else false
+    return true if rt.eq(a, b) else false
 
 
 def init():
@@ -0,0 +1,336 @@
+"""Peephole and dead code pass over a Context's bytecode, run by Context.to_code.
+
+The bytecode is decoded into a list of Instructions, jumps are resolved to instruction
+indexes, the passes mark instructions as dead, and the survivors are re-encoded with
+their jumps, loop targets and debug points remapped. Finally the stack depth is
+recomputed and checked at every instruction."""
+import pixie.vm.code as code
+from pixie.vm.object import affirm
+from pixie.vm.primitives import nil, false
+from rpython.rlib.rarithmetic import r_uint, intmask
+
+
+# Operand index of the relative jump for branching opcodes
+REL_JUMP_OPERAND = {code.JMP: 0,
+                    code.COND_BR: 0,
+                    code.ARG_COND_BR: 1,
+                    code.DUP_NTH_COND_BR: 1}
+
+# Operand index of the absolute ip in LOOP_RECUR
+LOOP_RECUR_TARGET = 2
+
+# Instructions that never fall through to the next one
+TERMINATORS = {code.RETURN: True,
+               code.TAIL_CALL: True,
+               code.RECUR: True,
+               code.JMP: True,
+               code.LOOP_RECUR: True}
+
+# Instructions that only push a value and can't fail, so a following POP can remove both
+PURE_PUSHES = {code.LOAD_CONST: True,
+               code.ARG: True,
+               code.DUP_NTH: True,
+               code.CLOSED_OVER: True,
+               code.PUSH_SELF: True}
+
+OPERAND_COUNTS = {code.LOAD_CONST: 1,
+                  code.ADD: 0,
+                  code.EQ: 0,
+                  code.INVOKE: 2,
+                  code.TAIL_CALL: 2,
+                  code.DUP_NTH: 1,
+                  code.RETURN: 0,
+                  code.COND_BR: 1,
+                  code.JMP: 1,
+                  code.CLOSED_OVER: 1,
+                  code.MAKE_CLOSURE: 1,
+                  code.SET_VAR: 0,
+                  code.POP: 0,
+                  code.DEREF_VAR: 0,
+                  code.RECUR: 1,
+                  code.LOOP_RECUR: 3,
+                  code.ARG: 1,
+                  code.PUSH_SELF: 0,
+                  code.POP_UP_N: 1,
+                  code.MAKE_VARIADIC: 1,
+                  code.LOAD_VAR_VALUE: 1,
+                  code.INVOKE_VAR: 3,
+                  code.ARG_COND_BR: 2,
+                  code.DUP_NTH_COND_BR: 2,
+                  code.SUB: 0,
+                  code.MUL: 0,
+                  code.LT: 0,
+                  code.GT: 0,
+                  code.NUM_EQ: 0,
+                  code.POP_BINDINGS: 0}
+
+
+class Instruction(object):
+    def __init__(self, pos, op, operands):
+        self.pos = pos
+        self.op = op
+        self.operands = operands
+        self.target = -1
+        self.dead = False
+
+    def is_jump(self):
+        return self.op in REL_JUMP_OPERAND or self.op == code.LOOP_RECUR
+
+
+def operand_count(bytecode, ip):
+    op = bytecode[ip]
+    if op == code.MAKE_MULTI_ARITY or op == code.PUSH_BINDINGS:
+        return 1 + intmask(bytecode[ip + 1])
+    cnt = OPERAND_COUNTS.get(op, -1)
+    affirm(cnt >= 0, u"Can't optimize unknown opcode " + unicode(code.BYTECODES[op]))
+    return cnt
+
+
+def decode(bytecode):
+    instrs = []
+    idx_for_pos = {}
+    ip = 0
+    while ip < len(bytecode):
+        cnt = operand_count(bytecode, ip)
+        idx_for_pos[ip] = len(instrs)
+        operands = [r_uint(bytecode[ip + 1 + x]) for x in range(cnt)]
+        instrs.append(Instruction(ip, bytecode[ip], operands))
+        ip += 1 + cnt
+
+    for instr in instrs:
+        if instr.op in REL_JUMP_OPERAND:
+            operand = REL_JUMP_OPERAND[instr.op]
+            target_pos = instr.pos + 1 + operand + intmask(instr.operands[operand])
+        elif instr.op == code.LOOP_RECUR:
+            target_pos = intmask(instr.operands[LOOP_RECUR_TARGET])
+        else:
+            continue
+        affirm(target_pos in idx_for_pos, u"Jump into the middle of an instruction")
+        instr.target = idx_for_pos[target_pos]
+    return instrs
+
+
+def next_live(instrs, idx):
+    """Index of the first live instruction at or after idx, a removed jump target falls
+       through to whatever follows it."""
+    while idx < len(instrs) and instrs[idx].dead:
+        idx += 1
+    return idx
+
+
+def live_target(instrs, instr):
+    return next_live(instrs, instr.target)
+
+
+def jump_targets(instrs):
+    targets = {}
+    for instr in instrs:
+        if not instr.dead and instr.is_jump():
+            targets[live_target(instrs, instr)] = True
+    return targets
+
+
+def thread_jumps(instrs):
+    """Points jumps that land on a JMP at that JMP's destination, and turns a JMP to a RETURN
+       into a RETURN."""
+    changed = False
+    for instr in instrs:
+        if instr.dead or instr.op not in REL_JUMP_OPERAND:
+            continue
+        seen = 0
+        target = live_target(instrs, instr)
+        while target < len(instrs) and instrs[target].op == code.JMP and seen < len(instrs):
+            instr.target = live_target(instrs, instrs[target])
+            target = instr.target
+            seen += 1
+            changed = True
+        if instr.op == code.JMP and target < len(instrs) and instrs[target].op == code.RETURN:
+            instr.op = code.RETURN
+            instr.operands = []
+            instr.target = -1
+            changed = True
+    return changed
+
+
+def fold_constant_branches(instrs, consts):
+    """Replaces LOAD_CONST, COND_BR with a JMP when the constant is falsy, and removes both
+       when it's truthy."""
+    changed = False
+    targets = jump_targets(instrs)
+    for i in range(len(instrs)):
+        instr = instrs[i]
+        if instr.dead or instr.op != code.LOAD_CONST:
+            continue
+        br_idx = next_live(instrs, i + 1)
+        if br_idx >= len(instrs) or instrs[br_idx].op != code.COND_BR or br_idx in targets:
+            continue
+        br = instrs[br_idx]
+        const = consts[instr.operands[0]]
+        instr.dead = True
+        if const is nil or const is false:
+            br.op = code.JMP
+        else:
+            br.dead = True
+        changed = True
+    return changed
+
+
+def remove_dead_pushes(instrs):
+    """Removes values that are pushed only to be popped, and POP_UP_N 0"""
+    changed = False
+    targets = jump_targets(instrs)
+    for i in range(len(instrs)):
+        instr = instrs[i]
+        if instr.dead:
+            continue
+        if instr.op == code.POP_UP_N and instr.operands[0] == 0:
+            instr.dead = True
+            changed = True
+            continue
+        if instr.op not in PURE_PUSHES:
+            continue
+        pop_idx = next_live(instrs, i + 1)
+        if pop_idx < len(instrs) and instrs[pop_idx].op == code.POP and pop_idx not in targets:
+            instr.dead = True
+            instrs[pop_idx].dead = True
+            changed = True
+    return changed
+
+
+def remove_unreachable(instrs):
+    """Removes instructions that can't be reached from the entry point, and jumps to the next
+       instruction"""
+    reachable = [False] * len(instrs)
+    todo = [next_live(instrs, 0)]
+    while len(todo) > 0:
+        idx = todo.pop()
+        if idx >= len(instrs) or reachable[idx]:
+            continue
+        reachable[idx] = True
+        instr = instrs[idx]
+        if instr.is_jump():
+            todo.append(live_target(instrs, instr))
+        if instr.op not in TERMINATORS:
+            todo.append(next_live(instrs, idx + 1))
+
+    changed = False
+    for i in range(len(instrs)):
+        instr = instrs[i]
+        if instr.dead:
+            continue
+        if not reachable[i]:
+            instr.dead = True
+            changed = True
+        elif instr.op == code.JMP and live_target(instrs, instr) == next_live(instrs, i + 1):
+            instr.dead = True
+            changed = True
+    return changed
+
+
+def encode(instrs, debug_points):
+    new_pos = [0] * (len(instrs) + 1)
+    pos = 0
+    for i in range(len(instrs)):
+        new_pos[i] = pos
+        if not instrs[i].dead:
+            pos += 1 + len(instrs[i].operands)
+    new_pos[len(instrs)] = pos
+
+    bytecode = []
+    new_debug_points = {}
+    for i in range(len(instrs)):
+        instr = instrs[i]
+        if instr.dead:
+            continue
+        dp = debug_points.get(instr.pos, None)
+        if dp is not None:
+            new_debug_points[len(bytecode)] = dp
+
+        operands = instr.operands
+        if instr.op in REL_JUMP_OPERAND:
+            operand = REL_JUMP_OPERAND[instr.op]
+            operand_pos = new_pos[i] + 1 + operand
+            target_pos = new_pos[live_target(instrs, instr)]
+            affirm(target_pos > operand_pos, u"Relative jumps must go forward")
+            operands[operand] = r_uint(target_pos - operand_pos)
+        elif instr.op == code.LOOP_RECUR:
+            operands[LOOP_RECUR_TARGET] = r_uint(new_pos[live_target(instrs, instr)])
+
+        bytecode.append(instr.op)
+        for x in operands:
+            bytecode.append(x)
+    return bytecode, new_debug_points
+
+
+def stack_effect(bytecode, ip):
+    op = bytecode[ip]
+    if op in (code.LOAD_CONST, code.ARG, code.DUP_NTH, code.CLOSED_OVER, code.PUSH_SELF,
+              code.LOAD_VAR_VALUE):
+        return 1
+    if op in (code.ADD, code.SUB, code.MUL, code.LT, code.GT, code.EQ, code.NUM_EQ,
+              code.SET_VAR, code.POP, code.COND_BR):
+        return -1
+    if op == code.INVOKE:
+        return 1 - intmask(bytecode[ip + 1])
+    if op == code.INVOKE_VAR:
+        return 1 - intmask(bytecode[ip + 2])
+    if op in (code.MAKE_CLOSURE, code.POP_UP_N):
+        return -intmask(bytecode[ip + 1])
+    if op == code.MAKE_MULTI_ARITY:
+        return 1 - intmask(bytecode[ip + 1])
+    if op == code.LOOP_RECUR:
+        return -intmask(bytecode[ip + 1]) - intmask(bytecode[ip + 2])
+    if op == code.PUSH_BINDINGS:
+        return -intmask(bytecode[ip + 1])
+    return 0
+
+
+def verify_stack(bytecode):
+    """Walks every path through the bytecode and returns the deepest stack it can reach.
+       Fails if the stack underflows or if two paths reach an instruction at different depths."""
+    depths = {}
+    todo = [(0, 0)]
+    max_depth = 0
+    while len(todo) > 0:
+        ip, depth = todo.pop()
+        affirm(ip < len(bytecode), u"Bytecode falls off the end")
+        seen = depths.get(ip, -1)
+        if seen >= 0:
+            affirm(seen == depth, u"Stack depth mismatch at " + unicode(str(ip)))
+            continue
+        depths[ip] = depth
+
+        op = bytecode[ip]
+        if op == code.DUP_NTH or op == code.DUP_NTH_COND_BR:
+            affirm(intmask(bytecode[ip + 1]) < depth, u"DUP_NTH reaches below the stack")
+        if op == code.RETURN or op == code.TAIL_CALL:
+            affirm(depth >= 1, u"Stack underflow")
+
+        next_depth = depth + stack_effect(bytecode, ip)
+        affirm(next_depth >= 0, u"Stack underflow at " + unicode(str(ip)))
+        if next_depth > max_depth:
+            max_depth = next_depth
+
+        next_ip = ip + 1 + operand_count(bytecode, ip)
+        if op in REL_JUMP_OPERAND:
+            operand_pos = ip + 1 + REL_JUMP_OPERAND[op]
+            todo.append((operand_pos + intmask(bytecode[operand_pos]), next_depth))
+        elif op == code.LOOP_RECUR:
+            todo.append((intmask(bytecode[ip + 1 + LOOP_RECUR_TARGET]), next_depth))
+        if op not in TERMINATORS:
+            todo.append((next_ip, next_depth))
+    return max_depth
+
+
+def optimize(bytecode, consts, debug_points):
+    """Returns the optimized bytecode, its debug points and the stack size it needs"""
+    instrs = decode(bytecode)
+    changed = True
+    while changed:
+        changed = thread_jumps(instrs)
+        changed = fold_constant_branches(instrs, consts) or changed
+        changed = remove_dead_pushes(instrs) or changed
+        changed = remove_unreachable(instrs) or changed
+
+    bytecode, debug_points = encode(instrs, debug_points)
+    return bytecode, debug_points, verify_stack(bytecode)
@@ -1,23 +1,36 @@
+py_object = object
 import pixie.vm.object as object
 from pixie.vm.object import affirm
 from pixie.vm.primitives import nil, true, false
 from pixie.vm.numbers import Integer
 import pixie.vm.protocols as proto
-from  pixie.vm.code import extend, as_var
+from  pixie.vm.code import extend, as_var, BaseCode
 from rpython.rlib.rarithmetic import r_uint, intmask, widen
 import rpython.rlib.jit as jit
 import pixie.vm.rt as rt
 
 
 
+class Edit(py_object):
+    """Marks the nodes a TransientVector owns and may mutate in place. persistent! kills the
+       edit, after which nodes are copied again as usual."""
+    def __init__(self):
+        self._alive = True
+
+
 class Node(object.Object):
+    """A node of the vector trie. Nodes built by catvec and subvec are relaxed: they have a
+       _sizes table holding the running count of items under each child, and their leaves may
+       hold fewer than 32 items. Every ancestor of a relaxed node is relaxed too, so a vector
+       whose root has no _sizes is an ordinary radix trie."""
     _type = object.Type(u"pixie.stdlib.PersistentVectorNode")
     def type(self):
         return Node._type
 
-    def __init__(self, edit, array = None):
+    def __init__(self, edit, array = None, sizes = None):
         self._edit = edit
         self._array = [None] * 32 if array is None else array
+        self._sizes = sizes
 
 
 EMPTY_NODE = Node(None)
@@ -43,29 +56,34 @@ class PersistentVector(object.Object):
         return PersistentVector(meta, self._cnt, self._shift, self._root, self._tail)
 
     def tailoff(self):
-        if self._cnt < 32:
-            return 0
-        return ((self._cnt - 1) >> 5) << 5
+        return self._cnt - r_uint(len(self._tail))
+
+    def is_relaxed(self):
+        return self._root._sizes is not None
+
+    def leaf_for(self, i):
+        """Returns the leaf array holding item i and the index of the item in it"""
+        affirm(0 <= i < intmask(self._cnt), u"Index out of Range")
+        tailoff = intmask(self.tailoff())
+        if i >= tailoff:
+            return self._tail, i - tailoff
+
+        node = self._root
+        level = intmask(self._shift)
+        while level > 0:
+            subidx, i = child_index(node, level, i)
+            node = node._array[subidx]
+            assert isinstance(node, Node)
+            level -= 5
+        return node._array, i
 
     def array_for(self, i):
-        if 0 <= i < self._cnt:
-            if i >= self.tailoff():
-                return self._tail
-
-            node = self._root
-            level = self._shift
-            while level > 0:
-                assert isinstance(node, Node)
-                node = node._array[(i >> level) & 0x01f]
-                level -= 5
-            return node._array
-
-        affirm(False, u"Index out of Range")
+        return self.leaf_for(intmask(i))[0]
 
     def nth(self, i, not_found=nil):
         if 0 <= i < self._cnt:
-            node = self.array_for(r_uint(i))
-            return node[i & 0x01f]
+            array, idx = self.leaf_for(i)
+            return array[idx]
 
         return not_found
 
@@ -78,6 +96,10 @@ class PersistentVector(object.Object):
             new_tail.append(val)
             return PersistentVector(self._meta, self._cnt + 1, self._shift, self._root, new_tail)
 
+        if self.is_relaxed():
+            new_root, new_shift = join(self._root, intmask(self._shift), Node(None, self._tail), 0)
+            return PersistentVector(self._meta, self._cnt + 1, r_uint(new_shift), new_root, [val])
+
         tail_node = Node(self._root._edit, self._tail)
         new_shift = self._shift
 
@@ -126,7 +148,10 @@ class PersistentVector(object.Object):
             new_tail = self._tail[:size]
             return PersistentVector(self._meta, self._cnt - 1, self._shift, self._root, new_tail)
 
-        new_tail = self.array_for(self._cnt - 2)
+        if self.is_relaxed():
+            return vector_from_tree(self._meta, self._root, intmask(self._shift), intmask(self._cnt) - 1)
+
+        new_tail = self.array_for(intmask(self._cnt) - 2)
 
         new_root = self.pop_tail(self._shift, self._root)
         new_shift = self._shift
@@ -140,10 +165,10 @@ class PersistentVector(object.Object):
         return PersistentVector(self._meta, self._cnt - 1, new_shift, new_root, new_tail)
 
     def pop_tail(self, level, node):
-        sub_idx = ((self._cnt - 1) >> level) & 0x01f
+        sub_idx = ((self._cnt - 2) >> level) & 0x01f
         if level > 5:
             new_child = self.pop_tail(level - 5, node._array[sub_idx])
-            if new_child is None or sub_idx == 0:
+            if new_child is None and sub_idx == 0:
                 return None
             else:
                 ret = Node(self._root._edit, node._array[:])
@@ -158,6 +183,368 @@ class PersistentVector(object.Object):
             ret._array[sub_idx] = None
             return ret
 
+    def assoc_n(self, i, val, f=None):
+        """Returns a copy with the item at i replaced by val, or by f called on the old item
+           when f is given. Only the path to i is copied. i may be the count, then the new
+           item is appended, f is called on nil for it."""
+        cnt = intmask(self._cnt)
+        if 0 <= i < cnt:
+            if i >= intmask(self.tailoff()):
+                new_tail = self._tail[:]
+                idx = i - intmask(self.tailoff())
+                new_tail[idx] = val if f is None else f.invoke1(new_tail[idx])
+                return PersistentVector(self._meta, self._cnt, self._shift, self._root, new_tail)
+            new_root = self.do_assoc(intmask(self._shift), self._root, i, val, f)
+            return PersistentVector(self._meta, self._cnt, self._shift, new_root, self._tail)
+        if i == cnt:
+            return self.conj(val if f is None else f.invoke1(nil))
+        affirm(False, u"Index out of Range")
+
+    def do_assoc(self, level, node, i, val, f):
+        ret = Node(node._edit, node._array[:], node._sizes)
+        if level == 0:
+            ret._array[i] = val if f is None else f.invoke1(ret._array[i])
+        else:
+            subidx, i = child_index(node, level, i)
+            child = node._array[subidx]
+            assert isinstance(child, Node)
+            ret._array[subidx] = self.do_assoc(level - 5, child, i, val, f)
+        return ret
+
+    def to_list(self):
+        cnt = intmask(self._cnt)
+        lst = [None] * cnt
+        i = 0
+        while i < cnt:
+            array = self.array_for(i)
+            for j in range(len(array)):
+                lst[i + j] = array[j]
+            i += len(array)
+        return lst
+
+    def to_tree(self):
+        """Returns the root and shift of a trie holding every item, the tail included. A trie
+           that is a single leaf has a shift of 0."""
+        tail = Node(None, self._tail)
+        if self.tailoff() == 0:
+            return tail, 0
+        return join(self._root, intmask(self._shift), tail, 0)
+
+    def transient(self):
+        if self.is_relaxed():
+            # Transients only know how to edit radix tries
+            return vector_from_list(self.to_list()).transient()
+        edit = Edit()
+        tail = self._tail + [None] * (32 - len(self._tail))
+        return TransientVector(self._cnt, self._shift, Node(edit, self._root._array[:]), tail, edit)
+
+
+class VectorChunkedSeq(object.Object):
+    """A seq over a vector that walks it one leaf array at a time. _i is the index of the
+       first item in _node, _offset the position in _node this seq starts at and _end the
+       index the seq stops before."""
+    _type = object.Type(u"pixie.stdlib.VectorChunkedSeq")
+    __immutable_fields__ = ["_vec", "_node", "_i", "_offset", "_end"]
+
+    def type(self):
+        return VectorChunkedSeq._type
+
+    def __init__(self, vec, node, i, offset, end):
+        self._vec = vec
+        self._node = node
+        self._i = i
+        self._offset = offset
+        self._end = end
+
+    def first(self):
+        return self._node[self._offset]
+
+    def next(self):
+        if self._offset + 1 < len(self._node) and self._i + self._offset + 1 < self._end:
+            return VectorChunkedSeq(self._vec, self._node, self._i, self._offset + 1, self._end)
+        return self.chunk_rest()
+
+    def chunk_first(self):
+        return VectorChunk(self._node, self._offset, min(len(self._node), self._end - self._i))
+
+    def chunk_rest(self):
+        i = self._i + len(self._node)
+        if i < self._end:
+            return VectorChunkedSeq(self._vec, self._vec.array_for(i), i, 0, self._end)
+        return nil
+
+
+class VectorChunk(object.Object):
+    """The items of a leaf array from _start up to _end, as returned by chunk-first. Unlike
+       ArraySlice it doesn't mark the list immutable, as leaf arrays share their list type with
+       vector tails, which get appended to."""
+    _type = object.Type(u"pixie.stdlib.VectorChunk")
+    __immutable_fields__ = ["_array", "_start", "_end"]
+
+    def type(self):
+        return VectorChunk._type
+
+    def __init__(self, array, start, end):
+        assert 0 <= start <= end <= len(array)
+        self._array = array
+        self._start = start
+        self._end = end
+
+    def count(self):
+        return self._end - self._start
+
+    def nth(self, i):
+        affirm(0 <= i < self.count(), u"Index out of Range")
+        return self._array[self._start + i]
+
+    def reduce(self, f, init):
+        for x in range(self._start, self._end):
+            if rt.reduced_QMARK_(init):
+                return rt.deref(init)
+            init = f.invoke2(init, self._array[x])
+        return init
+
+
+class SubVector(object.Object):
+    """An O(1) view of the items of a vector from _start up to _end. conj and assoc write
+       through to a new copy of the underlying vector, vec turns it into a vector of its own
+       by slicing the trie."""
+    _type = object.Type(u"pixie.stdlib.SubVector")
+    __immutable_fields__ = ["_meta", "_vec", "_start", "_end"]
+
+    def type(self):
+        return SubVector._type
+
+    def __init__(self, meta, vec, start, end):
+        self._meta = meta
+        self._vec = vec
+        self._start = start
+        self._end = end
+
+    def count(self):
+        return self._end - self._start
+
+    def nth(self, i):
+        affirm(0 <= i < self.count(), u"Index out of Range")
+        return self._vec.nth(self._start + i)
+
+    def conj(self, val):
+        return SubVector(self._meta, self._vec.assoc_n(self._end, val), self._start, self._end + 1)
+
+    def pop(self):
+        affirm(self._end != self._start, u"Can't pop an empty vector")
+        if self._end - 1 == self._start:
+            return EMPTY.with_meta(self._meta)
+        return SubVector(self._meta, self._vec, self._start, self._end - 1)
+
+    def assoc_n(self, i, val, f=None):
+        affirm(0 <= i <= self.count(), u"Index out of Range")
+        if i == self.count():
+            return self.conj(val if f is None else f.invoke1(nil))
+        return SubVector(self._meta, self._vec.assoc_n(self._start + i, val, f), self._start, self._end)
+
+    def seq(self):
+        if self._start == self._end:
+            return nil
+        array, idx = self._vec.leaf_for(self._start)
+        return VectorChunkedSeq(self._vec, array, self._start - idx, idx, self._end)
+
+    def reduce(self, f, init):
+        i = self._start
+        while i < self._end:
+            array, idx = self._vec.leaf_for(i)
+            stop = min(len(array), idx + self._end - i)
+            for j in range(idx, stop):
+                init = f.invoke([init, array[j]])
+                if rt.reduced_QMARK_(init):
+                    return rt.deref(init)
+            i += stop - idx
+        return init
+
+    def to_vector(self):
+        if self._start == self._end:
+            return EMPTY.with_meta(self._meta)
+        root, shift = self._vec.to_tree()
+        root = slice_right(root, shift, self._end)
+        root = slice_left(root, shift, self._start)
+        return vector_from_tree(self._meta, root, shift, self.count())
+
+
+class TransientVector(object.Object):
+    """A vector that is built by mutating nodes it owns, see Edit. The tail always has 32
+       slots, persistent! trims it."""
+    _type = object.Type(u"pixie.stdlib.TransientVector")
+
+    def type(self):
+        return TransientVector._type
+
+    def __init__(self, cnt, shift, root, tail, edit):
+        self._cnt = cnt
+        self._shift = shift
+        self._root = root
+        self._tail = tail
+        self._edit = edit
+
+    def ensure_editable(self):
+        affirm(self._edit._alive, u"Transient used after persistent! call")
+
+    def editable_node(self, node):
+        if node._edit is self._edit:
+            return node
+        return Node(self._edit, node._array[:])
+
+    def tailoff(self):
+        if self._cnt < 32:
+            return 0
+        return ((self._cnt - 1) >> 5) << 5
+
+    def persistent(self):
+        self.ensure_editable()
+        self._edit._alive = False
+        size = intmask(self._cnt - self.tailoff())
+        assert size >= 0 # for translation
+        return PersistentVector(nil, self._cnt, self._shift, self._root, self._tail[:size])
+
+    def nth(self, i, not_found=nil):
+        self.ensure_editable()
+        if not 0 <= i < self._cnt:
+            return not_found
+        if i >= self.tailoff():
+            return self._tail[i & 0x01f]
+        node = self._root
+        level = self._shift
+        while level > 0:
+            node = node._array[(i >> level) & 0x01f]
+            assert isinstance(node, Node)
+            level -= 5
+        return node._array[i & 0x01f]
+
+    def conj(self, val):
+        self.ensure_editable()
+        assert self._cnt < 0xFFFFFFFF
+        if self._cnt - self.tailoff() < 32:
+            self._tail[self._cnt & 0x01f] = val
+            self._cnt += 1
+            return self
+
+        tail_node = Node(self._edit, self._tail)
+        self._tail = [None] * 32
+        self._tail[0] = val
+        new_shift = self._shift
+
+        if (self._cnt >> 5) > (r_uint(1) << self._shift):
+            new_root = Node(self._edit)
+            new_root._array[0] = self._root
+            new_root._array[1] = self.new_path(self._shift, tail_node)
+            new_shift += 5
+        else:
+            new_root = self.push_tail(self._shift, self._root, tail_node)
+
+        self._root = new_root
+        self._shift = new_shift
+        self._cnt += 1
+        return self
+
+    def push_tail(self, level, parent, tail_node):
+        ret = self.editable_node(parent)
+        subidx = ((self._cnt - 1) >> level) & 0x01f
+        if level == 5:
+            node_to_insert = tail_node
+        else:
+            child = ret._array[subidx]
+            if child is not None:
+                assert isinstance(child, Node)
+                node_to_insert = self.push_tail(level - 5, child, tail_node)
+            else:
+                node_to_insert = self.new_path(level - 5, tail_node)
+
+        ret._array[subidx] = node_to_insert
+        return ret
+
+    def new_path(self, level, node):
+        if level == 0:
+            return node
+        ret = Node(self._edit)
+        ret._array[0] = self.new_path(level - 5, node)
+        return ret
+
+    def assoc_n_BANG_(self, i, val):
+        self.ensure_editable()
+        cnt = intmask(self._cnt)
+        if 0 <= i < cnt:
+            if i >= intmask(self.tailoff()):
+                self._tail[i & 0x01f] = val
+            else:
+                self._root = self.do_assoc(intmask(self._shift), self._root, i, val)
+            return self
+        if i == cnt:
+            return self.conj(val)
+        affirm(False, u"Index out of Range")
+
+    def do_assoc(self, level, node, i, val):
+        ret = self.editable_node(node)
+        if level == 0:
+            ret._array[i & 0x01f] = val
+        else:
+            subidx = (i >> level) & 0x01f
+            child = ret._array[subidx]
+            assert isinstance(child, Node)
+            ret._array[subidx] = self.do_assoc(level - 5, child, i, val)
+        return ret
+
+    def pop(self):
+        self.ensure_editable()
+        affirm(self._cnt != 0, u"Can't pop an empty vector")
+        if self._cnt == 1 or ((self._cnt - 1) & 0x01f) > 0:
+            self._cnt -= 1
+            self._tail[self._cnt & 0x01f] = None
+            return self
+
+        new_tail = self.editable_array_for(self._cnt - 2)
+        new_root = self.pop_tail(self._shift, self._root)
+        new_shift = self._shift
+        if new_root is None:
+            new_root = Node(self._edit)
+
+        if self._shift > 5 and new_root._array[1] is None:
+            child = new_root._array[0]
+            assert isinstance(child, Node)
+            new_root = self.editable_node(child)
+            new_shift -= 5
+
+        self._root = new_root
+        self._shift = new_shift
+        self._cnt -= 1
+        self._tail = new_tail
+        return self
+
+    def editable_array_for(self, i):
+        node = self._root
+        level = self._shift
+        while level > 0:
+            child = node._array[(i >> level) & 0x01f]
+            assert isinstance(child, Node)
+            node = self.editable_node(child)
+            level -= 5
+        return node._array
+
+    def pop_tail(self, level, node):
+        ret = self.editable_node(node)
+        subidx = ((self._cnt - 2) >> level) & 0x01f
+        if level > 5:
+            child = ret._array[subidx]
+            assert isinstance(child, Node)
+            new_child = self.pop_tail(level - 5, child)
+            if new_child is None and subidx == 0:
+                return None
+            ret._array[subidx] = new_child
+            return ret
+        elif subidx == 0:
+            return None
+        else:
+            ret._array[subidx] = None
+            return ret
+
 
 
 
@@ -213,14 +600,380 @@ def _reduce(self, f, init):
     return init
 
 
+@extend(proto._assoc, PersistentVector)
+def _assoc(self, idx, v):
+    affirm(isinstance(idx, Integer), u"Vector indexes must be integers")
+    return self.assoc_n(idx.int_val(), v)
+
+@extend(proto._seq, PersistentVector)
+def _seq(self):
+    if self._cnt == 0:
+        return nil
+    return VectorChunkedSeq(self, self.array_for(0), 0, 0, intmask(self._cnt))
+
+@extend(proto._first, VectorChunkedSeq)
+def _first(self):
+    return self.first()
+
+@extend(proto._next, VectorChunkedSeq)
+def _next(self):
+    return self.next()
+
+@extend(proto._seq, VectorChunkedSeq)
+def _seq(self):
+    return self
+
+@extend(proto._chunk_first, VectorChunkedSeq)
+def _chunk_first(self):
+    return self.chunk_first()
+
+@extend(proto._chunk_rest, VectorChunkedSeq)
+def _chunk_rest(self):
+    return self.chunk_rest()
+
+@extend(proto._count, VectorChunk)
+def _count(self):
+    return rt.wrap(self.count())
+
+@extend(proto._nth, VectorChunk)
+def _nth(self, idx):
+    return self.nth(idx.int_val())
+
+@extend(proto._reduce, VectorChunk)
+def _reduce(self, f, init):
+    return self.reduce(f, init)
+
+@extend(proto._transient, PersistentVector)
+def _transient(self):
+    return self.transient()
+
+@extend(proto._count, SubVector)
+def _count(self):
+    return rt.wrap(self.count())
+
+@extend(proto._nth, SubVector)
+def _nth(self, idx):
+    return self.nth(idx.int_val())
+
+@extend(proto._conj, SubVector)
+def _conj(self, v):
+    return self.conj(v)
+
+@extend(proto._push, SubVector)
+def _push(self, v):
+    return self.conj(v)
+
+@extend(proto._pop, SubVector)
+def _pop(self):
+    return self.pop()
+
+@extend(proto._assoc, SubVector)
+def _assoc(self, idx, v):
+    affirm(isinstance(idx, Integer), u"Vector indexes must be integers")
+    return self.assoc_n(idx.int_val(), v)
+
+@extend(proto._reduce, SubVector)
+def _reduce(self, f, init):
+    return self.reduce(f, init)
+
+@extend(proto._seq, SubVector)
+def _seq(self):
+    return self.seq()
+
+@extend(proto._meta, SubVector)
+def _meta(self):
+    return self._meta
+
+@extend(proto._with_meta, SubVector)
+def _with_meta(self, meta):
+    return SubVector(meta, self._vec, self._start, self._end)
+
+@extend(proto._transient, SubVector)
+def _transient(self):
+    return self.to_vector().transient()
+
+@extend(proto._count, TransientVector)
+def _count(self):
+    self.ensure_editable()
+    return rt.wrap(intmask(self._cnt))
+
+@extend(proto._nth, TransientVector)
+def _nth(self, idx):
+    return self.nth(idx.int_val())
+
+@extend(proto._conj_BANG_, TransientVector)
+def _conj_BANG_(self, v):
+    return self.conj(v)
+
+@extend(proto._assoc_BANG_, TransientVector)
+def _assoc_BANG_(self, idx, v):
+    affirm(isinstance(idx, Integer), u"Vector indexes must be integers")
+    return self.assoc_n_BANG_(idx.int_val(), v)
+
+@extend(proto._pop_BANG_, TransientVector)
+def _pop_BANG_(self):
+    return self.pop()
+
+@extend(proto._persistent_BANG_, TransientVector)
+def _persistent_BANG_(self):
+    return self.persistent()
+
+
+def vector_from_list(lst):
+    """Builds a vector holding the items of lst in one pass, filling the leaves 32 items at a
+       time and then building each level of the trie from the one below it"""
+    cnt = len(lst)
+    tailoff = 0 if cnt < 32 else ((cnt - 1) >> 5) << 5
+    assert tailoff >= 0
+    tail = lst[tailoff:]
+    if tailoff == 0:
+        return PersistentVector(nil, r_uint(cnt), r_uint(5), EMPTY_NODE, tail)
+
+    nodes = []
+    for i in range(0, tailoff, 32):
+        nodes.append(Node(None, lst[i:i + 32]))
+
+    shift = 5
+    while len(nodes) > 32:
+        parents = []
+        for i in range(0, len(nodes), 32):
+            parents.append(branch_node(nodes, i))
+        nodes = parents
+        shift += 5
+
+    return PersistentVector(nil, r_uint(cnt), r_uint(shift), branch_node(nodes, 0), tail)
+
+def branch_node(children, start):
+    node = Node(None)
+    for i in range(min(32, len(children) - start)):
+        node._array[i] = children[start + i]
+    return node
+
+
+def child_index(node, level, i):
+    """Returns the index of the child of node holding item i, and the index of the item
+       within that child"""
+    sizes = node._sizes
+    subidx = (i >> level) & 0x01f
+    if sizes is None:
+        return subidx, i - (subidx << level)
+    while sizes[subidx] <= i:
+        subidx += 1
+    if subidx > 0:
+        i -= sizes[subidx - 1]
+    return subidx, i
+
+def children(node):
+    if node._sizes is not None:
+        return node._array[:len(node._sizes)]
+    cnt = 0
+    while cnt < 32 and node._array[cnt] is not None:
+        cnt += 1
+    return node._array[:cnt]
+
+def tree_count(node, level):
+    """Number of items under node, level being 0 for leaves"""
+    if level == 0:
+        return len(node._array)
+    if node._sizes is not None:
+        return node._sizes[len(node._sizes) - 1]
+    kids = children(node)
+    last = kids[len(kids) - 1]
+    assert isinstance(last, Node)
+    return ((len(kids) - 1) << level) + tree_count(last, level - 5)
+
+def relaxed_node(kids, level):
+    sizes = [0] * len(kids)
+    total = 0
+    for x in range(len(kids)):
+        child = kids[x]
+        assert isinstance(child, Node)
+        total += tree_count(child, level - 5)
+        sizes[x] = total
+    return Node(None, kids + [None] * (32 - len(kids)), sizes)
+
+def without_last(kids):
+    stop = len(kids) - 1
+    assert stop >= 0
+    return kids[:stop]
+
+def pack_nodes(kids, level):
+    """Puts up to 64 nodes under one or two relaxed parents"""
+    if len(kids) <= 32:
+        return [relaxed_node(kids, level)]
+    return [relaxed_node(kids[:32], level), relaxed_node(kids[32:], level)]
+
+def concat_nodes(left, lshift, right, rshift):
+    """Joins two tries along the seam between them. Only the nodes on the right edge of left
+       and the left edge of right are copied, leaves that fit together are merged. Returns one
+       or two nodes at the level of the taller trie."""
+    if lshift > rshift:
+        kids = children(left)
+        last = kids[len(kids) - 1]
+        assert isinstance(last, Node)
+        merged = concat_nodes(last, lshift - 5, right, rshift)
+        return pack_nodes(without_last(kids) + merged, lshift)
+    if lshift < rshift:
+        kids = children(right)
+        first = kids[0]
+        assert isinstance(first, Node)
+        merged = concat_nodes(left, lshift, first, rshift - 5)
+        return pack_nodes(merged + kids[1:], rshift)
+    if lshift == 0:
+        if len(left._array) + len(right._array) <= 32:
+            return [Node(None, left._array + right._array)]
+        return [left, right]
+    lkids = children(left)
+    rkids = children(right)
+    last = lkids[len(lkids) - 1]
+    first = rkids[0]
+    assert isinstance(last, Node) and isinstance(first, Node)
+    merged = concat_nodes(last, lshift - 5, first, rshift - 5)
+    return pack_nodes(without_last(lkids) + merged + rkids[1:], lshift)
+
+def join(left, lshift, right, rshift):
+    """Concatenates two tries, returning the new root and shift"""
+    nodes = concat_nodes(left, lshift, right, rshift)
+    shift = max(lshift, rshift)
+    if len(nodes) == 1 and shift > 0:
+        return nodes[0], shift
+    return relaxed_node(nodes, shift + 5), shift + 5
+
+def slice_right(node, level, end):
+    """Returns node with only its first end items"""
+    assert end > 0
+    if level == 0:
+        return node if end == len(node._array) else Node(None, node._array[:end])
+    subidx, i = child_index(node, level, end - 1)
+    assert subidx >= 0
+    child = node._array[subidx]
+    assert isinstance(child, Node)
+    return relaxed_node(node._array[:subidx] + [slice_right(child, level - 5, i + 1)], level)
+
+def slice_left(node, level, start):
+    """Returns node without its first start items"""
+    if start == 0:
+        return node
+    assert start > 0
+    if level == 0:
+        return Node(None, node._array[start:])
+    subidx, i = child_index(node, level, start)
+    assert subidx >= 0
+    child = node._array[subidx]
+    assert isinstance(child, Node)
+    return relaxed_node([slice_left(child, level - 5, i)] + children(node)[subidx + 1:], level)
+
+def pop_leaf(node, level):
+    """Returns node without its last leaf, or None if that was all it held, and the leaf"""
+    kids = children(node)
+    last = kids[len(kids) - 1]
+    assert isinstance(last, Node)
+    rest = without_last(kids)
+    if level == 5:
+        leaf = last
+    else:
+        new_last, leaf = pop_leaf(last, level - 5)
+        if new_last is not None:
+            rest.append(new_last)
+    if len(rest) == 0:
+        return None, leaf
+    return relaxed_node(rest, level), leaf
+
+def vector_from_tree(meta, root, shift, cnt):
+    """Builds a vector of cnt items from a trie as returned by to_tree, its last leaf becomes
+       the tail"""
+    if shift == 0:
+        return PersistentVector(meta, r_uint(cnt), r_uint(5), EMPTY_NODE, root._array)
+    new_root, leaf = pop_leaf(root, shift)
+    if new_root is None:
+        return PersistentVector(meta, r_uint(cnt), r_uint(5), EMPTY_NODE, leaf._array)
+    while shift > 5 and len(children(new_root)) == 1:
+        child = new_root._array[0]
+        assert isinstance(child, Node)
+        new_root = child
+        shift -= 5
+    return PersistentVector(meta, r_uint(cnt), r_uint(shift), new_root, leaf._array)
+
+
 @as_var("vector")
 def vector__args(args):
-    acc = EMPTY
-    for x in range(len(args)):
-        acc = acc.conj(args[x])
-    return acc
+    return vector_from_list(args)
+
+@as_var("assoc")
+def assoc(coll, k, v):
+    return rt._assoc(coll, k, v)
+
+@as_var("update")
+def update(coll, k, f):
+    """Returns coll with the value at k replaced by f called on it. Vectors do this with a
+       single path copy."""
+    affirm(isinstance(f, BaseCode), u"update expects a fn")
+    if isinstance(coll, PersistentVector) and isinstance(k, Integer):
+        return coll.assoc_n(k.int_val(), nil, f)
+    if isinstance(coll, SubVector) and isinstance(k, Integer):
+        return coll.assoc_n(k.int_val(), nil, f)
+    return rt._assoc(coll, k, f.invoke1(rt._val_at(coll, k, nil)))
+
+@as_var("subvec")
+def subvec(v, start, end):
+    """Returns a view of the items of v from start up to end, without copying them"""
+    affirm(isinstance(start, Integer) and isinstance(end, Integer), u"subvec indexes must be integers")
+    s = start.int_val()
+    e = end.int_val()
+    if isinstance(v, SubVector):
+        affirm(0 <= s <= e <= v.count(), u"Index out of Range")
+        return SubVector(v._meta, v._vec, v._start + s, v._start + e)
+    affirm(isinstance(v, PersistentVector), u"subvec expects a vector")
+    assert isinstance(v, PersistentVector)
+    affirm(0 <= s <= e <= intmask(v._cnt), u"Index out of Range")
+    return SubVector(v._meta, v, s, e)
+
+@as_var("catvec")
+def catvec(a, b):
+    """Returns a vector of the items of a followed by those of b. Only the edges of the two
+       tries along the seam are copied."""
+    a = rt.vec(a)
+    b = rt.vec(b)
+    assert isinstance(a, PersistentVector) and isinstance(b, PersistentVector)
+    if b._cnt == 0:
+        return a
+    if a._cnt == 0:
+        return b.with_meta(a._meta)
+    lroot, lshift = a.to_tree()
+    rroot, rshift = b.to_tree()
+    root, shift = join(lroot, lshift, rroot, rshift)
+    return vector_from_tree(a._meta, root, shift, intmask(a._cnt + b._cnt))
+
+@as_var("vec")
+def vec(coll):
+    """Returns a vector of the items in coll, Arrays are copied in one pass"""
+    from pixie.vm.array import Array, ArraySlice
+    if isinstance(coll, PersistentVector):
+        return coll
+    if isinstance(coll, SubVector):
+        return coll.to_vector()
+    if isinstance(coll, Array):
+        return vector_from_list(coll._list)
+    if isinstance(coll, ArraySlice):
+        start = coll._start
+        end = coll._end
+        assert 0 <= start <= end
+        return vector_from_list(coll._list[start:end])
+    if coll is nil:
+        return EMPTY
+    return rt._persistent_BANG_(rt._reduce(coll, proto._conj_BANG_, EMPTY.transient()))
+
+@as_var("into")
+def into(to, coll):
+    """Conjs the items of coll onto to, through a transient if to has one"""
+    if isinstance(to, PersistentVector) and to._cnt == 0 and to._meta is nil:
+        return rt.vec(coll)
+    if rt.instance_QMARK_(rt.IToTransient.deref(), to):
+        return rt._persistent_BANG_(rt._reduce(coll, proto._conj_BANG_, rt._transient(to)))
+    return rt._reduce(coll, proto._conj, to)
 
 
 proto.IVector.add_satisfies(PersistentVector._type)
+proto.IVector.add_satisfies(SubVector._type)
 
 EMPTY = PersistentVector(nil, r_uint(0), r_uint(5), EMPTY_NODE, [])
@@ -8,12 +8,14 @@ from pixie.vm.primitives import true, false, nil
 import pixie.vm.numbers as numbers
 import rpython.rlib.jit as jit
 import rpython.rlib.rstacklet as rstacklet
-from rpython.rlib.rarithmetic import r_uint
+from rpython.rlib.rarithmetic import r_uint, intmask
 
 
 defprotocol("pixie.stdlib", "ISeq", ["-first", "-next"])
 defprotocol("pixie.stdlib", "ISeqable", ["-seq"])
 
+defprotocol("pixie.stdlib", "IChunkedSeq", ["-chunk-first", "-chunk-rest"])
+
 defprotocol("pixie.stdlib", "ICounted", ["-count"])
 
 defprotocol("pixie.stdlib", "IIndexed", ["-nth"])
@@ -45,6 +47,14 @@ IMap = as_var("pixie.stdlib", "IMap")(Protocol(u"IMap"))
 
 defprotocol("pixie.stdlib", "IMeta", ["-with-meta", "-meta"])
 
+defprotocol("pixie.stdlib", "IToTransient", ["-transient"])
+
+defprotocol("pixie.stdlib", "ITransientCollection", ["-conj!", "-persistent!"])
+
+defprotocol("pixie.stdlib", "ITransientAssociative", ["-assoc!"])
+
+defprotocol("pixie.stdlib", "ITransientStack", ["-pop!"])
+
 def default_str(x):
     from pixie.vm.string import String
 
@@ -58,6 +68,18 @@ _meta.set_default_fn(wrap_fn(lambda x: nil))
 #_first = PolymorphicFn("-first")
 #_next = PolymorphicFn("-next")
 
+def first_of_seq(x):
+    """-first of a seqable that isn't a seq, such as a vector, is the -first of its seq"""
+    return rt._first(rt.seq(x))
+
+def next_of_seq(x):
+    return rt._next(rt.seq(x))
+
+# Defaults rather than extends, extending ISeq would make vectors satisfy it, and the
+# compiler and seq? use that to tell seqs from other data
+_first.set_default_fn(wrap_fn(first_of_seq))
+_next.set_default_fn(wrap_fn(next_of_seq))
+
 @as_var("first")
 def first(x):
     return rt._first(x)
@@ -66,6 +88,19 @@ def first(x):
 def next(x):
     return rt.seq(rt._next(x))
 
+@as_var("chunk-first")
+def chunk_first(x):
+    return rt._chunk_first(x)
+
+@as_var("chunk-rest")
+def chunk_rest(x):
+    """The seq after the first chunk, or nil"""
+    return rt._chunk_rest(x)
+
+@as_var("chunked-seq?")
+def chunked_seq_QMARK_(x):
+    return true if rt.instance_QMARK_(rt.IChunkedSeq.deref(), x) else false
+
 @as_var("seq")
 def seq(x):
     return rt._seq(x)
@@ -158,6 +193,22 @@ def conj(a, b):
 def nth(a, b):
     return rt._nth(a, b)
 
+@as_var("transient")
+def transient(coll):
+    return rt._transient(coll)
+
+@as_var("persistent!")
+def persistent(coll):
+    return rt._persistent_BANG_(coll)
+
+@as_var("assoc!")
+def assoc_BANG_(coll, k, v):
+    return rt._assoc_BANG_(coll, k, v)
+
+@as_var("pop!")
+def pop_BANG_(coll):
+    return rt._pop_BANG_(coll)
+
 
 @as_var("str")
 def str__args(args):
@@ -170,6 +221,7 @@ def str__args(args):
 @as_var("apply")
 @jit.unroll_safe
 def apply__args(args):
+    from pixie.vm.array import Array, ArraySlice
     last_itm = args[len(args) - 1]
     if not rt.instance_QMARK_(rt.IIndexed.deref(), last_itm) or \
         not rt.instance_QMARK_(rt.ICounted.deref(), last_itm):
@@ -181,8 +233,13 @@ def apply__args(args):
 
     list_copy(args, 1, out_args, 0, argc)
 
-    for x in range(rt.count(last_itm).int_val()):
-        out_args[argc + x] = rt.nth(last_itm, rt.wrap(x))
+    if isinstance(last_itm, ArraySlice):
+        last_itm.copy_to(out_args, intmask(argc))
+    elif isinstance(last_itm, Array):
+        list_copy(last_itm._list, 0, out_args, argc, len(last_itm._list))
+    else:
+        for x in range(rt.count(last_itm).int_val()):
+            out_args[argc + x] = rt.nth(last_itm, rt.wrap(x))
 
     return fn.invoke(out_args)
 
@@ -205,22 +262,10 @@ import pixie.vm.rt as rt
 
 @as_var("load_file")
 def load_file(filename):
-    import pixie.vm.reader as reader
-    import pixie.vm.compiler as compiler
-    f = open(str(filename._str))
-    data = f.read()
-    f.close()
-    rdr = reader.StringReader(unicode(data))
-    result = nil
-    while True:
-        form = reader.read(rdr, False)
-        print "printing"
-        print rt.str(form)._str
-        if form is reader.eof:
-            return result
-        print "compiling"
-        result = compiler.compile(form).invoke([])
-        print "compiled"
+    import pixie.vm.bytecode_cache as bytecode_cache
+    from pixie.vm.string import String
+    affirm(isinstance(filename, String), u"load_file expects a string")
+    return bytecode_cache.load_file(filename._str.encode("utf-8"))
 
 @as_var("extend")
 def extend(proto_fn, tp, fn):
@@ -321,4 +366,35 @@ def push_binding_frame():
 @as_var("pop-binding-frame!")
 def pop_binding_frame():
     code._dynamic_vars.pop_binding_frame()
-    return nil
\ No newline at end of file
+    return nil
+
+@as_var("with-bindings*")
+def with_bindings(binds, f):
+    """Calls f with the vars named in the flat name/val seq binds bound to the vals. The
+       names are resolved like resolve does, this is what with-bindings uses when binds is
+       not a literal vector"""
+    code._dynamic_vars.push_binding_frame()
+    try:
+        binds = rt.seq(binds)
+        while binds is not nil:
+            var = rt.first(binds)
+            if not isinstance(var, Var):
+                var = get_var_if_defined(rt.namespace(var), rt.name(var), nil)
+            affirm(isinstance(var, Var), u"with-bindings expects names of defined vars")
+            binds = rt.next(binds)
+            affirm(binds is not nil, u"with-bindings expects an even number of forms")
+            var.set_value(rt.first(binds))
+            binds = rt.next(binds)
+        return f.invoke([])
+    finally:
+        code._dynamic_vars.pop_binding_frame()
+
+@as_var("inline-cache-stats")
+def inline_cache_stats(f):
+    """Returns a vector of [hits misses] for each call site in f"""
+    from pixie.vm.persistent_vector import EMPTY
+    affirm(isinstance(f, code.Code) or isinstance(f, code.Closure), u"inline-cache-stats expects an interpreted fn")
+    acc = EMPTY
+    for cache in f.get_inline_caches():
+        acc = acc.conj(rt.vector(rt.wrap(cache.hits), rt.wrap(cache.misses)))
+    return acc
@@ -189,15 +189,15 @@ class UnmachedListReader(ReaderHandler):
 
 class VectorReader(ReaderHandler):
     def invoke(self, rdr, ch):
-        acc = EMPTY_VECTOR
+        acc = EMPTY_VECTOR.transient()
         while True:
             eat_whitespace(rdr)
             ch = rdr.read()
             if ch == u"]":
-                return acc
+                return acc.persistent()
 
             rdr.unread(ch)
-            acc = rt.conj(acc, read(rdr, True))
+            acc.conj(read(rdr, True))
 
 class UnmachedVectorReader(ReaderHandler):
     def invoke(self, rdr, ch):
@@ -1,7 +1,38 @@
 __config__ = None
 py_list = list
 from rpython.rlib.objectmodel import specialize
-
+import rpython.rlib.jit as jit
+
+
+@specialize.call_location()
+def invoke_tuple(fn, args):
+    """Calls fn with a tuple of args, through the fixed-arity entry points when possible.
+       Specialized per call site, as tuples of different lengths can't be unified."""
+    argc = len(args)
+    if argc == 0:
+        return fn.invoke0()
+    if argc == 1:
+        return fn.invoke1(args[0])
+    if argc == 2:
+        return fn.invoke2(args[0], args[1])
+    if argc == 3:
+        return fn.invoke3(args[0], args[1], args[2])
+    return fn.invoke(py_list(args))
+
+
+@specialize.call_location()
+def invoke_direct(fn, cache, args):
+    """Like invoke_tuple, but resolves protocol fns to the impl for the args' types through
+       cache and calls that impl's raw entry point. Traces keep calling fn, whose lookup the
+       JIT already constant folds."""
+    argc = len(args)
+    if argc == 0 or argc > 3 or jit.we_are_jitted():
+        return invoke_tuple(fn, args)
+    if argc == 1:
+        return cache.lookup(fn, args[0], None).raw_invoke1(args[0])
+    if argc == 2:
+        return cache.lookup(fn, args[0], args[1]).raw_invoke2(args[0], args[1])
+    return cache.lookup(fn, args[0], args[1]).raw_invoke3(args[0], args[1], args[2])
 
 
 def init():
@@ -14,21 +45,39 @@ def init():
 
     _type_registry.set_registry(code._ns_registry)
 
+    def direct_call(var):
+        """Calls the fn var was bound to at init directly, so the translator sees its exact
+           class. Protocol fns go straight to the impl for the first args' types, found
+           through an inline cache that follows extends. Falls back to going through the var
+           once it is redefined or made dynamic, both of which bump its rev."""
+        root = var.deref()
+        rev = var._rev
+        cache = code.InlineCache()
+        def call(*args):
+            if var._rev == rev:
+                return invoke_direct(root, cache, args)
+            return invoke_tuple(var, args)
+        return call
+
     def unwrap(fn):
+        if isinstance(fn, code.Var):
+            call = direct_call(fn)
+        else:
+            call = lambda *args: invoke_tuple(fn, args)
         if isinstance(fn, code.Var) and hasattr(fn.deref(), "_returns"):
             tp = fn.deref()._returns
             if tp is bool:
                 def wrapper(*args):
-                    ret = fn.invoke(py_list(args))
+                    ret = call(*args)
                     if ret is nil or ret is false:
                         return False
                     return True
                 return wrapper
             elif tp is r_uint:
-                return lambda *args: fn.invoke(py_list(args)).r_uint_val()
+                return lambda *args: call(*args).r_uint_val()
             elif tp is unicode:
                 def wrapper(*args):
-                    ret = fn.invoke(py_list(args))
+                    ret = call(*args)
                     if ret is nil:
                         return None
                     affirm(isinstance(ret, String), u"Invalid return value, expected String")
@@ -36,7 +85,7 @@ def init():
                 return wrapper
             else:
                 assert False, "Don't know how to convert" + str(tp)
-        return lambda *args: fn.invoke(py_list(args))
+        return call
 
 
     if globals().has_key("__inited__"):
@@ -78,46 +127,41 @@ def init():
 
     from pixie.vm.code import _ns_registry, BaseCode, munge
 
-    for name, var in _ns_registry._registry[u"pixie.stdlib"]._registry.iteritems():
-        name = munge(name)
-        print name
+    def bind(var):
+        name = munge(var._name)
+        if name in globals() or not var.is_defined():
+            return
         if isinstance(var.deref(), BaseCode):
             globals()[name] = unwrap(var)
         else:
             globals()[name] = var
 
+    for var in _ns_registry._registry[u"pixie.stdlib"]._registry.values():
+        bind(var)
+
 
     import pixie.vm.bootstrap
 
     def reinit():
-        for name, var in _ns_registry._registry[u"pixie.stdlib"]._registry.iteritems():
-            name = munge(name)
-            if name in globals():
-                continue
-
-            print "Found ->> ", name, var.deref()
-            if isinstance(var.deref(), BaseCode):
-                globals()[name] = unwrap(var)
-            else:
-                globals()[name] = var
+        # only look at the vars defined by the last stdlib form
+        defined = code._defined_vars_log
+        code._defined_vars_log = []
+        for var in defined:
+            if var._ns == u"pixie.stdlib":
+                bind(var)
 
-    f = open("pixie/stdlib.lisp")
-    data = f.read()
-    f.close()
-    rdr = reader.MetaDataReader(reader.StringReader(unicode(data)), u"pixie/stdlib.pixie")
-    result = nil
+    import pixie.vm.bytecode_cache as bytecode_cache
 
     @wrap_fn
     def run_load_stdlib():
         with compiler.with_ns(u"pixie.stdlib"):
-            while True:
-                form = reader.read(rdr, False)
-                if form is reader.eof:
-                    return result
-                result = compiler.compile(form).invoke([])
-                reinit()
-
-    stacklet.with_stacklets(run_load_stdlib)
+            return bytecode_cache.load_file("pixie/stdlib.lisp", reinit)
+
+    code._defined_vars_log = []
+    try:
+        stacklet.with_stacklets(run_load_stdlib)
+    finally:
+        code._defined_vars_log = None
 
 
 
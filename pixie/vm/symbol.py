@@ -33,8 +33,17 @@ class Symbol(object.Object):
 
 
 
+# Only the reader and compiler intern, their symbols come from source and are bounded by it.
+# Symbols built by the running program go through the symbol var and are left to the GC.
+_symbols = {}
+
 def symbol(s):
-    return Symbol(s)
+    """Returns the interned symbol for s, so its names are only split and wrapped once"""
+    sym = _symbols.get(s, None)
+    if sym is None:
+        sym = Symbol(s)
+        _symbols[s] = sym
+    return sym
 
 @extend(proto._eq, Symbol)
 def _eq(self, other):
@@ -59,7 +68,7 @@ def _namespace(self):
 @as_var("symbol")
 def _symbol(s):
     affirm(isinstance(s, String), u"Symbol name must be a string")
-    return symbol(s._str)
+    return Symbol(s._str)
 
 
 
@@ -0,0 +1,98 @@
+from pixie.vm.compiler import with_ns, NS_VAR
+from pixie.vm.primitives import nil
+import pixie.vm.bytecode_cache as bytecode_cache
+import pixie.vm.code as code
+import pixie.vm.rt as rt
+import os
+
+rt.init()
+
+def load(path):
+    with with_ns(u"user"):
+        NS_VAR.deref().include_stdlib()
+        return bytecode_cache.load_file(path)
+
+def write(path, s):
+    f = open(path, "w")
+    f.write(s)
+    f.close()
+
+
+def test_cache_is_written_and_used(tmpdir):
+    src = str(tmpdir.join("prog.lisp"))
+    write(src, "(def cached-val [1 :k \"s\" 'sym '(a b) -7])\n(defn cached-fn [x] (if x (count cached-val) -1))\n(cached-fn true)\n")
+    assert load(src).int_val() == 6
+
+    cache = str(tmpdir.join("prog.pxic"))
+    assert os.path.exists(cache)
+    os.utime(src, (0, 0))
+
+    records = bytecode_cache.decode_records(bytecode_cache.read_file(cache)).records
+    assert len(records) == 3
+
+    code.intern_var(u"user", u"cached-val").set_root(nil)
+    assert load(src).int_val() == 6
+    assert rt.count(code.intern_var(u"user", u"cached-val").deref()).int_val() == 6
+
+def test_stale_or_bad_caches_are_ignored(tmpdir):
+    src = str(tmpdir.join("prog.lisp"))
+    cache = str(tmpdir.join("prog.pxic"))
+    write(src, "(+ 1 2)\n")
+    write(cache, "PXIC garbage")
+    os.utime(src, (0, 0))
+    assert load(src).int_val() == 3
+
+    os.utime(cache, (0, 0))
+    write(src, "(+ 1 3)\n")
+    assert load(src).int_val() == 4
+
+def test_ns_is_restored_from_cache(tmpdir):
+    src = str(tmpdir.join("prog.lisp"))
+    write(src, "(ns cache-test)\n(def x 42)\n")
+    load(src)
+    os.utime(src, (0, 0))
+    code.intern_var(u"cache-test", u"x").set_root(nil)
+    load(src)
+    assert code.intern_var(u"cache-test", u"x").deref().int_val() == 42
+
+def test_files_without_ns_load_into_the_callers_ns(tmpdir):
+    src = str(tmpdir.join("prog.lisp"))
+    write(src, "(def no-ns-x 1)\n")
+    load(src)
+    os.utime(src, (0, 0))
+    with with_ns(u"cache-caller"):
+        NS_VAR.deref().include_stdlib()
+        bytecode_cache.load_file(src)
+    assert code.get_var_if_defined(u"cache-caller", u"no-ns-x") is not None
+
+    records = bytecode_cache.decode_records(bytecode_cache.read_file(str(tmpdir.join("prog.pxic")))).records
+    assert [r.ns for r in records] == [None]
+
+def test_caches_from_other_compiler_flags_are_ignored(tmpdir):
+    import pixie.vm.compiler as compiler
+    src = str(tmpdir.join("prog.lisp"))
+    cache = str(tmpdir.join("prog.pxic"))
+    write(src, "(defn flagged-f [x] (+ x 1))\n(flagged-f 1)\n")
+    load(src)
+    os.utime(src, (0, 0))
+    compiler.USE_SUPERINSTRUCTIONS = not compiler.USE_SUPERINSTRUCTIONS
+    try:
+        assert not bytecode_cache.decode_records(bytecode_cache.read_file(cache)).is_usable(cache, u"user")
+        assert load(src).int_val() == 2
+        assert bytecode_cache.decode_records(bytecode_cache.read_file(cache)).is_usable(cache, u"user")
+    finally:
+        compiler.USE_SUPERINSTRUCTIONS = not compiler.USE_SUPERINSTRUCTIONS
+
+def test_direct_links_survive_the_cache(tmpdir):
+    src = str(tmpdir.join("linked.lisp"))
+    write(src, "(set-direct-linking! true)\n(defn linked-g [x] (inc x))\n(linked-g 1)\n")
+    try:
+        assert load(src).int_val() == 2
+        os.utime(src, (0, 0))
+
+        records = bytecode_cache.decode_records(bytecode_cache.read_file(str(tmpdir.join("linked.pxic")))).records
+        links = records[2].code_obj.get_links()
+        assert links.values() == [code.intern_var(u"user", u"linked-g")]
+        assert load(src).int_val() == 2
+    finally:
+        code._ns_registry.find_or_make(u"user")._direct_link = False
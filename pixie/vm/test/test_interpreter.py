@@ -0,0 +1,464 @@
+from pixie.vm.reader import read, StringReader, eof
+from pixie.vm.compiler import compile, with_ns, NS_VAR
+from pixie.vm.numbers import Integer
+from pixie.vm.primitives import nil, true, false
+from pixie.vm.object import WrappedException
+import pixie.vm.object as object
+import pixie.vm.code as code
+import pixie.vm.rt as rt
+from rpython.rlib.rarithmetic import r_uint
+
+rt.init()
+
+def eval_string(s):
+    with with_ns(u"user"):
+        NS_VAR.deref().include_stdlib()
+        rdr = StringReader(unicode(s))
+        result = nil
+        while True:
+            form = read(rdr, False)
+            if form is eof:
+                return result
+
+            result = compile(form).invoke([])
+
+def compile_string(s):
+    with with_ns(u"user"):
+        NS_VAR.deref().include_stdlib()
+        return compile(read(StringReader(unicode(s)), True))
+
+def opcodes(code_obj):
+    return [code.BYTECODES[x] if x < len(code.BYTECODES) else None for x in code.unpack_bytecode(code_obj.get_bytecode())]
+
+
+def test_superinstructions_are_emitted():
+    ops = opcodes(compile_string(u"(count [1 2])"))
+    assert "INVOKE_VAR" in ops
+    assert "DEREF_VAR" not in ops
+
+    ops = opcodes(compile_string(u"count"))
+    assert "LOAD_VAR_VALUE" in ops
+
+def test_var_invoke():
+    retval = eval_string(u"(count [1 2 3])")
+    assert isinstance(retval, Integer) and retval.int_val() == 3
+
+    retval = eval_string(u"(def f (fn [] 42)) (f)")
+    assert isinstance(retval, Integer) and retval.int_val() == 42
+
+def test_cond_br_on_locals():
+    retval = eval_string(u"((fn [x] (if x 1 2)) nil)")
+    assert retval.int_val() == 2
+
+    retval = eval_string(u"((fn [x] (if x 1 2)) 0)")
+    assert retval.int_val() == 1
+
+    retval = eval_string(u"(let [x false y 3] (if x 1 (if y y 2)))")
+    assert retval.int_val() == 3
+
+def test_mutual_tail_calls_use_constant_stack():
+    retval = eval_string(u"""(def tc-even? (fn [n] (if (eq n 0) true (tc-odd? (- n 1)))))
+                             (def tc-odd? (fn [n] (if (eq n 0) false (tc-even? (- n 1)))))
+                             (tc-even? 5000)""")
+    assert retval is true
+
+def test_non_tail_calls_return():
+    retval = eval_string(u"((fn [] (do (if true (count [1]) 2) 5)))")
+    assert retval.int_val() == 5
+
+    retval = eval_string(u"((fn [] (do (loop [i 0] (if (eq i 3) (count [i]) (recur (+ i 1)))) 9)))")
+    assert retval.int_val() == 9
+
+    retval = eval_string(u"((fn [] [(count [1 2])]))")
+    assert rt.count(retval).int_val() == 1
+
+    retval = eval_string(u"((fn [& r] (apply str r)) 1 2)")
+    assert retval._str == u"12"
+
+def test_fn_recur_rebinds_args():
+    retval = eval_string(u"((fn [i acc] (if (eq i 1000) acc (recur (+ i 1) (+ acc 2)))) 0 0)")
+    assert retval.int_val() == 2000
+
+    retval = eval_string(u"((fn [i] (let [j (+ i 1)] (if (eq j 100) j (recur j)))) 0)")
+    assert retval.int_val() == 100
+
+    retval = eval_string(u"((fn [n & r] (if (eq n 0) (count r) (recur (- n 1) r))) 3 1 2)")
+    assert retval.int_val() == 2
+
+def test_fixed_arity_invoke():
+    add = code.wrap_fn(lambda a, b: Integer(a.int_val() + b.int_val()))
+    assert add.invoke2(Integer(1), Integer(2)).int_val() == 3
+    assert add.invoke([Integer(1), Integer(2)]).int_val() == 3
+
+    f = eval_string(u"(fn ([] 0) ([a] a) ([a b] b) ([a b c] c))")
+    assert f.invoke0().int_val() == 0
+    assert f.invoke1(Integer(1)).int_val() == 1
+    assert f.invoke2(Integer(1), Integer(2)).int_val() == 2
+    assert f.invoke3(Integer(1), Integer(2), Integer(3)).int_val() == 3
+
+    retval = eval_string(u"((fn [& r] (count r)) 1 2 3)")
+    assert retval.int_val() == 3
+
+def test_inline_caches():
+    f = eval_string(u"(fn [x] (-count x))")
+    f.invoke([eval_string(u"[1 2]")])
+    f.invoke([eval_string(u"[1 2 3]")])
+    retval = f.invoke([eval_string(u"[1]")])
+    assert retval.int_val() == 1
+
+    caches = f.get_inline_caches()
+    assert len(caches) == 1
+    assert caches[0].misses == 1 and caches[0].hits == 2
+
+    f.invoke([eval_string(u"(list 1 2)")])
+    assert caches[0].misses == 2
+
+    f = eval_string(u"(fn [x] (do (-count x) nil))")
+    f.invoke([eval_string(u"[1 2]")])
+    f.invoke([eval_string(u"[1 2]")])
+    assert f.get_inline_caches()[0].hits == 1
+
+    stats = eval_string(u"(inline-cache-stats (fn [x] (-count x)))")
+    assert rt.count(stats).int_val() == 1
+
+def test_inline_cache_sees_extend():
+    from pixie.vm.protocols import _str
+    f = eval_string(u"(fn [x] (-str x))")
+    assert f.invoke([Integer(1)])._str == u"1"
+
+    old = _str.get_protocol_fn(Integer._type, _str._rev)
+    try:
+        _str.extend(Integer._type, code.wrap_fn(lambda x: rt.wrap(u"int")))
+        assert f.invoke([Integer(1)])._str == u"int"
+    finally:
+        _str.extend(Integer._type, old)
+    assert f.invoke([Integer(1)])._str == u"1"
+
+def test_math_opcodes():
+    ops = opcodes(compile_string(u"(fn [x y] (+ x y))").get_consts()[0])
+    assert "ADD" in ops
+
+    assert eval_string(u"((fn [x y] (+ x y)) 1 2)").int_val() == 3
+    assert eval_string(u"((fn [x y] (- x y)) 1 2)").int_val() == -1
+    assert eval_string(u"((fn [x y] (* x y)) 3 2)").int_val() == 6
+    assert eval_string(u"(< 1 2)") is true
+    assert eval_string(u"(> 1 2)") is false
+    assert eval_string(u"(= 2 2)") is true
+    assert eval_string(u"(= :a :a)") is true
+    assert eval_string(u"(= [1] 1)") is false
+    assert eval_string(u"(-num-eq 2 3)") is false
+    assert eval_string(u"(+ 1 2 3)").int_val() == 6
+    assert eval_string(u"(< 1 2 3)") is true
+    assert eval_string(u"(platform+ 1 2)").int_val() == 3
+
+class Tally(object.Object):
+    """Throwaway type for extending the global protocols without touching stdlib types"""
+    _type = object.Type(u"pixie.test.Tally")
+
+    def __init__(self, n):
+        self._n = n
+
+    def type(self):
+        return Tally._type
+
+def test_math_opcodes_fall_back_to_imath():
+    from pixie.vm.numbers import _add
+    _add.extend2(Tally._type, Tally._type, code.wrap_fn(lambda a, b: Tally(a._n + b._n)))
+    add = eval_string(u"(fn [x y] (+ x y))")
+    assert add.invoke([Tally(1), Tally(2)])._n == 3
+
+def test_packed_bytecode():
+    bytecode = [code.LOAD_CONST, r_uint(3), code.RETURN]
+    packed = code.pack_bytecode(bytecode)
+    assert len(packed) == 7
+    assert code.unpack_bytecode(packed) == bytecode
+
+    bytecode = [code.JMP, r_uint(70000), code.RETURN]
+    packed = code.pack_bytecode(bytecode)
+    assert len(packed) == 13
+    assert code.unpack_bytecode(packed) == bytecode
+
+def test_constant_pool():
+    code_obj = compile_string(u"[1 1 \"a\" \"a\" :k :k]")
+    consts = code_obj.get_consts()
+    assert len(consts) == 4
+
+    other = compile_string(u"[\"a\" 1]")
+    assert other.get_consts()[1] is consts[2]
+    assert other.get_consts()[2] is consts[1]
+
+def test_closures_capture_only_used_locals():
+    f = eval_string(u"(let [a 1 b 2 c 3] (fn [] b))")
+    assert len(f.get_closed_overs()) == 1
+    assert f.invoke([]).int_val() == 2
+
+    f = eval_string(u"(let [a 1] (fn [] (+ a a)))")
+    assert len(f.get_closed_overs()) == 1
+    assert f.invoke([]).int_val() == 2
+
+    retval = eval_string(u"((let [a 1] (fn [] (let [b 2] ((fn [] (+ a b)))))))")
+    assert retval.int_val() == 3
+
+    retval = eval_string(u"(let [x 1] (let [x 2] x) x)")
+    assert retval.int_val() == 1
+
+def test_macro_expansion_cache():
+    from pixie.vm.compiler import MacroCache, _macro_cache, call_macro
+    eval_string(u"(defmacro twice [x] (list 'do x x))")
+    form = read(StringReader(u"(twice 1)"), True)
+    var = code.intern_var(u"user", u"twice")
+
+    expansion = call_macro(var, form, None)
+    assert call_macro(var, form, None) is expansion
+
+    eval_string(u"(defmacro twice [x] (list 'do x x x))")
+    assert call_macro(var, form, None) is not expansion
+
+    cache = MacroCache(2)
+    a, b, c = Integer(1), Integer(2), Integer(3)
+    cache.put(a, var, a)
+    cache.put(b, var, b)
+    assert cache.get(a, var) is a
+    cache.put(c, var, c)
+    assert cache.get(b, var) is None
+    assert cache.get(a, var) is a
+    assert cache.get(c, var) is c
+
+def test_macroexpand():
+    retval = eval_string(u"(macroexpand-1 '(defn f [x] x))")
+    assert rt.name(rt.first(retval)) == u"def"
+
+    retval = eval_string(u"(macroexpand '(defn f [x] x))")
+    assert rt.name(rt.first(retval)) == u"def"
+
+    retval = eval_string(u"(macroexpand 1)")
+    assert retval.int_val() == 1
+
+def test_rt_calls_follow_redefined_vars():
+    var = code.intern_var(u"pixie.stdlib", u"count")
+    old = var.deref()
+    assert rt.count(eval_string(u"[1 2]")).int_val() == 2
+    try:
+        var.set_root(code.wrap_fn(lambda x: Integer(42)))
+        assert rt.count(eval_string(u"[1 2]")).int_val() == 42
+    finally:
+        var.set_root(old)
+    assert rt.count(eval_string(u"[1 2]")).int_val() == 2
+
+def test_rt_protocol_calls_follow_extends():
+    import pixie.vm.object as object
+    import pixie.vm.protocols as proto
+    tp = object.Type(u"user.RtCounted")
+    class Counted(object.Object):
+        def type(self):
+            return tp
+
+    proto._count.extend(tp, code.wrap_fn(lambda x: Integer(7)))
+    assert rt._count(Counted()).int_val() == 7
+    assert rt._count(Counted()).int_val() == 7
+    proto._count.extend(tp, code.wrap_fn(lambda x: Integer(8)))
+    assert rt._count(Counted()).int_val() == 8
+    assert rt._count(eval_string(u"[1 2]")).int_val() == 2
+
+def test_binding_frames():
+    dv = code.DynamicVars()
+    var = code.Var(u"user", u"dyn")
+    a, b = Integer(1), Integer(2)
+    assert dv.get_var_value(var, nil) is nil
+
+    dv.set_var_value(var, a)
+    dv.push_binding_frame()
+    assert dv.get_var_value(var, nil) is a
+    dv.set_var_value(var, b)
+    assert dv.get_var_value(var, nil) is b
+    dv.push_binding_frame()
+    assert dv.get_var_value(var, nil) is b
+    dv.pop_binding_frame()
+    dv.pop_binding_frame()
+    assert dv.get_var_value(var, nil) is a
+
+    retval = eval_string(u"""(def dyn-x 1)
+                             (set-dynamic! (resolve 'user/dyn-x))
+                             [(with-bindings ['user/dyn-x 2] (with-bindings [] dyn-x)) dyn-x]""")
+    assert rt.nth(retval, Integer(0)).int_val() == 2
+    assert rt.nth(retval, Integer(1)).int_val() == 1
+
+def test_binding_form():
+    ops = opcodes(compile_string(u"(binding [foo 1] foo)"))
+    assert "PUSH_BINDINGS" in ops and "POP_BINDINGS" in ops
+
+    assert eval_string(u"(binding [foo 1] foo)").int_val() == 1
+    assert eval_string(u"(binding [foo 1 foo 2] (+ foo 1))").int_val() == 3
+    assert eval_string(u"(with-bindings ['pixie.stdlib/foo 3] foo)").int_val() == 3
+    assert eval_string(u"(binding [foo 1])") is nil
+    assert eval_string(u"foo").int_val() == 42
+
+    f = eval_string(u"(fn [] (binding [foo 5] (throw \"boom\")))")
+    try:
+        f.invoke([])
+        assert False
+    except WrappedException:
+        pass
+    assert eval_string(u"foo").int_val() == 42
+
+def test_computed_bindings():
+    assert eval_string(u"(let [b ['pixie.stdlib/foo 3]] (with-bindings b (+ foo 1)))").int_val() == 4
+    assert eval_string(u"(with-bindings (vector 'pixie.stdlib/foo 5) foo)").int_val() == 5
+    assert eval_string(u"(with-bindings (list) foo)").int_val() == 42
+
+    f = eval_string(u"(fn [b] (with-bindings b (throw \"boom\")))")
+    try:
+        f.invoke([eval_string(u"['pixie.stdlib/foo 5]")])
+        assert False
+    except WrappedException:
+        pass
+    assert eval_string(u"foo").int_val() == 42
+
+def test_direct_linking():
+    import pixie.vm.compiler as compiler
+    eval_string(u"(defn linked-f [x] (+ x 1))")
+    compiler.DIRECT_LINK = True
+    try:
+        f = eval_string(u"(fn [x] (linked-f x))")
+    finally:
+        compiler.DIRECT_LINK = False
+    var = code.intern_var(u"user", u"linked-f")
+    assert var.deref() in f.get_consts()
+    assert "INVOKE_VAR" not in opcodes(f)
+    assert f.invoke([Integer(1)]).int_val() == 2
+
+    eval_string(u"(defn linked-f [x] (+ x 2))")
+    assert var.deref() in f.get_consts()
+    assert f.invoke([Integer(1)]).int_val() == 3
+
+    var.set_dynamic()
+    assert var in f.get_consts()
+    assert f.invoke([Integer(1)]).int_val() == 3
+
+def test_linked_code_can_be_freed():
+    import gc, weakref
+    import pixie.vm.compiler as compiler
+    eval_string(u"(defn freed-f [x] x)")
+    var = code.intern_var(u"user", u"freed-f")
+    compiler.DIRECT_LINK = True
+    try:
+        refs = [weakref.ref(eval_string(u"(fn [x] (freed-f x) (freed-f x))")) for x in range(20)]
+    finally:
+        compiler.DIRECT_LINK = False
+    gc.collect()
+    assert [r for r in refs if r() is not None] == []
+    assert len(var._dependents) < 20
+
+def test_multi_arity_table():
+    f = compile_string(u"(fn ([] 0) ([a b] b) ([a b & r] r))")
+    assert "MAKE_MULTI_ARITY" not in opcodes(f)
+    fn = f.invoke([])
+    assert isinstance(fn, code.MultiArityFn)
+    assert fn.fixed_arity_count() == 3 and fn.get_fixed_arity(1) is None
+    assert fn.invoke([]).int_val() == 0
+    assert fn.invoke([Integer(1), Integer(2)]).int_val() == 2
+    assert rt.count(fn.invoke([Integer(1), Integer(2), Integer(3)])).int_val() == 1
+
+    f = compile_string(u"(let [x 1] (fn ([] x) ([a] a)))")
+    assert "MAKE_MULTI_ARITY" in opcodes(f)
+    fn = f.invoke([])
+    assert fn.invoke([]).int_val() == 1
+    assert fn.invoke([Integer(2)]).int_val() == 2
+    try:
+        fn.invoke([Integer(1), Integer(2)])
+        assert False
+    except WrappedException:
+        pass
+
+def test_rest_args_are_sliced():
+    from pixie.vm.array import ArraySlice
+    rest = eval_string(u"((fn [a & r] r) 1 2 3)")
+    assert isinstance(rest, ArraySlice)
+    assert rt.count(rest).int_val() == 2
+    assert rt.nth(rest, Integer(1)).int_val() == 3
+
+    assert eval_string(u"((fn [a & r] (apply + a r)) 1 2)").int_val() == 3
+    assert eval_string(u"((fn [a & r] (reduce -add a r)) 1 2 3)").int_val() == 6
+    assert rt.count(eval_string(u"((fn [a & r] r) 1)")).int_val() == 0
+
+def test_transients():
+    from pixie.vm.persistent_vector import PersistentVector
+    retval = eval_string(u"(persistent! (pop! (assoc! (conj! (conj! (transient [1]) 2) 3) 0 :a)))")
+    assert isinstance(retval, PersistentVector)
+    assert rt.count(retval).int_val() == 2
+    assert rt.nth(retval, Integer(1)).int_val() == 2
+
+    retval = eval_string(u"(transduce (map inc) conj [1 2 3])")
+    assert isinstance(retval, PersistentVector)
+    assert rt.nth(retval, Integer(2)).int_val() == 4
+    assert rt.count(eval_string(u"(conj (transduce conj [1 2]) 3)")).int_val() == 3
+
+def test_vec_and_into():
+    from pixie.vm.persistent_vector import PersistentVector
+    retval = eval_string(u"((fn [& r] (vec r)) 1 2 3)")
+    assert isinstance(retval, PersistentVector) and rt.count(retval).int_val() == 3
+
+    retval = eval_string(u"(into [1] (list 2 3))")
+    assert rt.count(retval).int_val() == 3 and rt.nth(retval, Integer(2)).int_val() == 3
+
+    retval = eval_string(u"(into [] [1 2])")
+    assert rt.count(retval).int_val() == 2
+    assert rt.count(eval_string(u"(vec nil)")).int_val() == 0
+
+def test_vector_assoc_and_update():
+    retval = eval_string(u"(update (assoc [1 2 3] 0 5) 1 inc)")
+    assert rt.nth(retval, Integer(0)).int_val() == 5
+    assert rt.nth(retval, Integer(1)).int_val() == 3
+    assert rt.count(eval_string(u"(assoc [1] 1 2)")).int_val() == 2
+    retval = eval_string(u"(update [1 2] 2 (fn [x] (if (eq x nil) 9 x)))")
+    assert rt.count(retval).int_val() == 3
+    assert rt.nth(retval, Integer(2)).int_val() == 9
+
+    retval = eval_string(u"(update (subvec [1 2 3] 0 2) 1 inc)")
+    assert rt.count(retval).int_val() == 2
+    assert rt.nth(retval, Integer(1)).int_val() == 3
+    retval = eval_string(u"(update (subvec [1 2 3] 0 2) 2 (fn [x] (if (eq x nil) 9 x)))")
+    assert rt.nth(retval, Integer(2)).int_val() == 9
+
+def test_vector_chunked_seq():
+    from pixie.vm.persistent_vector import VectorChunkedSeq
+    v = eval_string(u"(loop [acc [] i 0] (if (eq i 70) acc (recur (conj acc i) (+ i 1))))")
+    s = rt.seq(v)
+    assert isinstance(s, VectorChunkedSeq)
+    assert rt.count(rt.chunk_first(s)).int_val() == 32
+
+    total = 0
+    while s is not nil:
+        total += rt.first(s).int_val()
+        s = rt.next(s)
+    assert total == sum(range(70))
+
+    assert eval_string(u"(first [7 8])").int_val() == 7
+    assert eval_string(u"(first (next [7 8]))").int_val() == 8
+    assert eval_string(u"(next [7])") is nil
+    assert eval_string(u"(first (subvec [6 7 8] 1 3))").int_val() == 7
+    assert eval_string(u"(first [])") is nil
+    assert eval_string(u"(seq? [7 8])") is false
+    assert eval_string(u"(seq [])") is nil
+    assert eval_string(u"(reduce -add 0 (seq [1 2 3]))").int_val() == 6
+    assert eval_string(u"(reduce (fn [a x] (if (eq x 40) (reduced a) (+ a x))) 0 (seq %s))" % rt._str(v)._str).int_val() == sum(range(40))
+
+
+def test_subvec_and_catvec():
+    assert eval_string(u"(count (subvec [1 2 3 4 5] 1 4))").int_val() == 3
+    assert eval_string(u"(nth (subvec [1 2 3 4 5] 1 4) 0)").int_val() == 2
+    assert eval_string(u"(reduce + 0 (subvec [1 2 3 4 5] 1 4))").int_val() == 9
+    assert eval_string(u"(nth (conj (subvec [1 2 3 4 5] 1 3) 9) 2)").int_val() == 9
+    assert eval_string(u"(count (-pop (subvec [1 2 3 4 5] 1 3)))").int_val() == 1
+    assert eval_string(u"(nth (subvec (subvec [1 2 3 4 5] 1 5) 2 4) 1)").int_val() == 5
+    assert eval_string(u"(vector? (subvec [1 2 3] 0 1))") is true
+    assert rt._str(eval_string(u"(subvec [1 2 3 4] 1 3)"))._str == u"[2, 3]"
+
+    v = eval_string(u"""(let [big (loop [acc [] i 0] (if (eq i 2000) acc (recur (conj acc i) (+ i 1))))]
+                          (catvec (subvec big 100 1100) (catvec (subvec big 5 37) [-1])))""")
+    assert rt.count(v).int_val() == 1033
+    assert rt.nth(v, rt.wrap(0)).int_val() == 100
+    assert rt.nth(v, rt.wrap(999)).int_val() == 1099
+    assert rt.nth(v, rt.wrap(1000)).int_val() == 5
+    assert rt.nth(v, rt.wrap(1032)).int_val() == -1
+    assert eval_string(u"(count (catvec [] []))").int_val() == 0
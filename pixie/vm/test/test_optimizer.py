@@ -0,0 +1,77 @@
+from pixie.vm.reader import read, StringReader, MetaDataReader
+from pixie.vm.compiler import compile, with_ns, NS_VAR
+from pixie.vm.primitives import nil, true
+from pixie.vm.object import WrappedException
+from rpython.rlib.rarithmetic import r_uint
+import pixie.vm.optimizer as optimizer
+import pixie.vm.code as code
+import pixie.vm.rt as rt
+
+rt.init()
+
+def compile_string(s):
+    with with_ns(u"user"):
+        NS_VAR.deref().include_stdlib()
+        return compile(read(MetaDataReader(StringReader(unicode(s)), u"test"), True))
+
+def opcodes(bytecode):
+    ops = []
+    ip = 0
+    while ip < len(bytecode):
+        ops.append(code.BYTECODES[bytecode[ip]])
+        ip += 1 + optimizer.operand_count(bytecode, ip)
+    return ops
+
+def bc(*items):
+    return [r_uint(x) for x in items]
+
+
+def test_jump_threading():
+    # COND_BR -> JMP -> RETURN becomes COND_BR -> RETURN
+    bytecode = bc(code.ARG, 0,
+                  code.COND_BR, 5,
+                  code.ARG, 0,
+                  code.JMP, 3,
+                  code.ARG, 0,
+                  code.RETURN)
+    new_bc, dps, stack_size = optimizer.optimize(bytecode, [], {})
+    assert opcodes(new_bc) == ["ARG", "COND_BR", "ARG", "RETURN", "ARG", "RETURN"]
+    assert stack_size == 1
+
+def test_dead_pushes_and_empty_lets():
+    bytecode = bc(code.LOAD_CONST, 0,
+                  code.POP,
+                  code.LOAD_CONST, 0,
+                  code.POP_UP_N, 0,
+                  code.RETURN,
+                  code.LOAD_CONST, 0)
+    new_bc, dps, stack_size = optimizer.optimize(bytecode, [nil], {})
+    assert opcodes(new_bc) == ["LOAD_CONST", "RETURN"]
+
+def test_constant_if_folding():
+    ops = opcodes(code.unpack_bytecode(compile_string(u"(if true 1 2)").get_bytecode()))
+    assert ops == ["LOAD_CONST", "RETURN"]
+
+    ops = opcodes(code.unpack_bytecode(compile_string(u"(if nil 1 2)").get_bytecode()))
+    assert ops == ["LOAD_CONST", "RETURN"]
+
+    assert compile_string(u"(if nil 1 2)").invoke([]).int_val() == 2
+
+def test_debug_points_are_remapped():
+    code_obj = compile_string(u"(do 1 (if true (count 1) 2))")
+    bytecode = code.unpack_bytecode(code_obj.get_bytecode())
+    invoke_ip = opcodes(bytecode).index("INVOKE_VAR") * 2
+    assert bytecode[invoke_ip] == code.INVOKE_VAR
+    assert code_obj.get_debug_point(invoke_ip) is not None
+
+def test_verifier_rejects_bad_stacks():
+    bytecode = bc(code.POP, code.RETURN)
+    try:
+        optimizer.verify_stack(bytecode)
+        assert False
+    except WrappedException:
+        pass
+
+def test_loop_targets_are_remapped():
+    retval = compile_string(u"(loop [i 0] (do 1 (if (= i 10) i (recur (+ i 1)))))").invoke([])
+    assert retval.int_val() == 10
@@ -1,5 +1,8 @@
 import unittest
-from pixie.vm.code import intern_var, get_var_if_defined
+from pixie.vm.code import intern_var, get_var_if_defined, Namespace
+from pixie.vm.symbol import symbol
+import pixie.vm.symbol as symbol_mod
+import pixie.vm.rt as rt
 
 
 def test_intern():
@@ -7,4 +10,24 @@ def test_intern():
     assert intern_var(u"foo2", u"bar") is not intern_var(u"foo", u"bar")
 
     assert get_var_if_defined(u"foo", u"bar")
-    assert get_var_if_defined(u"foo2", u"bar")
\ No newline at end of file
+    assert get_var_if_defined(u"foo2", u"bar")
+
+def test_resolve_cache():
+    assert symbol(u"x") is symbol(u"x")
+
+    lib = Namespace(u"lib")
+    ns = Namespace(u"app")
+    ns.add_refer(lib, refer_all=True)
+    assert ns.resolve(symbol(u"x")) is None
+
+    lib_x = lib.intern_or_make(u"x")
+    assert ns.resolve(symbol(u"x")) is lib_x
+    assert ns.resolve(symbol(u"x")) is lib_x
+
+    app_x = ns.intern_or_make(u"x")
+    assert ns.resolve(symbol(u"x")) is app_x
+
+def test_runtime_symbols_are_not_interned():
+    sym = symbol_mod._symbol.invoke1(rt.wrap(u"built-at-runtime"))
+    assert sym._str == u"built-at-runtime"
+    assert u"built-at-runtime" not in symbol_mod._symbols
@@ -1,5 +1,6 @@
 import unittest
 from pixie.vm.persistent_vector import PersistentVector, EMPTY
+from pixie.vm.object import WrappedException
 
 
 def test_vector_conj():
@@ -8,4 +9,101 @@ def test_vector_conj():
     for x in range(1200):
         acc = acc.conj(x)
         for y in range(x):
-            assert acc.nth(y) == y, "Error at: " + str(x) + " and " + str(y)
\ No newline at end of file
+            assert acc.nth(y) == y, "Error at: " + str(x) + " and " + str(y)
+
+def test_transient_vector():
+    base = EMPTY
+    for x in range(40):
+        base = base.conj(x)
+
+    t = base.transient()
+    for x in range(40, 1200):
+        t.conj(x)
+    t.assoc_n_BANG_(3, -3)
+    t.assoc_n_BANG_(1100, -1100)
+    for x in range(1200, 1000, -1):
+        assert t.nth(x - 1) == (-1100 if x - 1 == 1100 else x - 1)
+        t.pop()
+
+    acc = t.persistent()
+    assert acc._cnt == 1000
+    for y in range(1000):
+        assert acc.nth(y) == (-3 if y == 3 else y)
+    for y in range(40):
+        assert base.nth(y) == y
+
+    acc = acc.conj(1000).pop().pop()
+    assert acc._cnt == 999 and acc.nth(998) == 998
+
+    t = EMPTY.transient()
+    t.conj(1)
+    t.persistent()
+    try:
+        t.conj(2)
+        assert False
+    except WrappedException:
+        pass
+
+
+def test_vector_from_list():
+    from pixie.vm.persistent_vector import vector_from_list
+    for cnt in [0, 1, 32, 33, 64, 65, 1056, 1057, 33 * 32 + 40, 40000]:
+        acc = vector_from_list(range(cnt))
+        assert acc._cnt == cnt
+        for y in range(0, cnt, 7):
+            assert acc.nth(y) == y
+        if cnt > 0:
+            assert acc.nth(cnt - 1) == cnt - 1
+
+        acc = acc.conj(cnt)
+        assert acc._cnt == cnt + 1 and acc.nth(cnt) == cnt
+
+
+def test_vector_assoc_n():
+    from pixie.vm.persistent_vector import vector_from_list
+    from pixie.vm.code import wrap_fn
+    base = vector_from_list(range(2000))
+    acc = base
+    for x in range(0, 2000, 3):
+        acc = acc.assoc_n(x, -x)
+    acc = acc.assoc_n(1500, None, wrap_fn(lambda v: v * 10))
+    for y in range(2000):
+        assert base.nth(y) == y
+        if y == 1500:
+            assert acc.nth(y) == -15000
+        else:
+            assert acc.nth(y) == (-y if y % 3 == 0 else y)
+    assert acc.assoc_n(2000, 7).nth(2000) == 7
+
+
+def test_vector_join_and_slice():
+    from pixie.vm.persistent_vector import vector_from_list, vector_from_tree, join, SubVector
+    def catvec(a, b):
+        lroot, lshift = a.to_tree()
+        rroot, rshift = b.to_tree()
+        root, shift = join(lroot, lshift, rroot, rshift)
+        return vector_from_tree(None, root, shift, a._cnt + b._cnt)
+
+    for lcnt, rcnt in [(1, 60), (5, 1100), (1100, 5), (1057, 40000), (33, 64)]:
+        acc = catvec(vector_from_list(range(lcnt)), vector_from_list(range(lcnt, lcnt + rcnt)))
+        assert acc._cnt == lcnt + rcnt
+        for y in range(0, lcnt + rcnt, 7):
+            assert acc.nth(y) == y
+        acc = acc.assoc_n(lcnt, -1).conj(-2)
+        assert acc.nth(lcnt) == -1 and acc.nth(lcnt + rcnt) == -2
+        for x in range(40):
+            acc = acc.pop()
+        assert acc._cnt == lcnt + rcnt - 39 and acc.nth(acc._cnt - 1) == acc._cnt - 1
+
+    acc = EMPTY
+    for x in range(2000):
+        acc = catvec(acc, vector_from_list([x]))
+    assert acc._shift <= 10
+    assert [acc.nth(y) for y in range(2000)] == range(2000)
+
+    sub = SubVector(None, acc, 40, 1500)
+    assert sub.count() == 1460 and sub.nth(0) == 40
+    assert sub.conj(-1).nth(1460) == -1 and acc.nth(1500) == 1500
+    sliced = sub.to_vector()
+    assert sliced._cnt == 1460
+    assert [sliced.nth(y) for y in range(1460)] == range(40, 1500)
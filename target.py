@@ -127,6 +127,9 @@ def run_debug(argv):
     CodeWriter.debug = True
     run_child(globals(), locals())
 
+# The runtime is built here, at translation time. The namespace and type registries, the keyword
+# cache and the compiled stdlib all become part of the binary's prebuilt heap, so a translated
+# pixie starts with them ready and never runs rt.init.
 import pixie.vm.rt as rt
 rt.init()
 stacklet.global_state = stacklet.GlobalState()